@@ -8,13 +8,17 @@ Original file is located at
 # Step 1 load data and pandas
 import pandas as pd
 
-#read csvs
-pd.read_csv('/content/Inventory_Turnover.csv')
-pd.read_csv('/content/Restock_data.csv')
+from vending_io import intern_ids, load_inventory_cached, load_restock_cached
 
-#create copies of files
-df_inventory = pd.read_csv('/content/Inventory_Turnover.csv').copy()
-df_restock = pd.read_csv('/content/Restock_data.csv').copy()
+# read each csv once, with declared dtypes and fixed date formats;
+# the cleaned frames are reused from the Parquet cache while the csvs are unchanged
+df_inventory = load_inventory_cached('/content/Inventory_Turnover.csv')
+df_restock = load_restock_cached('/content/Restock_data.csv')
+
+# intern sku / device_id / global_order_id into shared int32-coded dictionaries
+# (device_id codes line up across both frames), so every groupby, isin,
+# value_counts and unstack below works on the integer codes, not the hex strings
+id_dicts = intern_ids(df_inventory, df_restock)
 
 # confirm csvs are loaded
 print(df_inventory.head())
@@ -57,19 +61,8 @@ print('Data Types:\n', df_inventory.dtypes)
 print()
 print('Data Types:\n', df_restock.dtypes)
 
-# 2c. Convert data types: object -> string, dispense_date and restock_date -> datetime
-
-# convert object data types to strings in inventory csv
-for col in ['sku', 'device_id']:
-    df_inventory[col] = df_inventory[col].astype('string')
-
-# convert object data types to strings in restock csv
-for col in ['device_id', 'global_order_id','currency_code']:
-    df_restock[col] = df_restock[col].astype('string')
-
-# convert dates to date_time
-df_inventory['dispense_date'] = pd.to_datetime(df_inventory['dispense_date'], dayfirst=False)
-df_restock['restock_date'] = pd.to_datetime(df_restock['restock_date'], dayfirst=False)
+# 2c. Data types: the loaders already declare categorical ids, int32 quantities,
+# float64 totals, and parse dispense_date (DD-MM-YYYY) / restock_date explicitly
 
 # make the date column the index for TSA
 df_inventory.index = df_inventory['dispense_date']
@@ -86,6 +79,13 @@ print(df_restock.head())
 
 # all data has been converted to the correct formats
 
+# 2d. Shared aggregation cubes: each frame is summed once to (device, sku, day);
+# every monthly series and SKU pivot below is a cached roll-up of these cubes
+from vending_features import AggregationCube
+
+inv_cube  = AggregationCube(df_inventory, 'qty_dispensed', 'dispense_date', dims=('device_id', 'sku'))
+rest_cube = AggregationCube(df_restock,   'total',         'restock_date',  dims=('device_id',))
+
 # Step 3 exploratory data analysis
 
 # 3a. Descriptive stats
@@ -197,11 +197,9 @@ In other words, package_qty by itself does not strongly predict the numeric volu
 
 import matplotlib.pyplot as plt
 
-# monthly counts
-inv_monthly = df_inventory['dispense_date'].dt.to_period('M') \
-                        .value_counts().sort_index()
-rest_monthly = df_restock['restock_date'].dt.to_period('M') \
-                        .value_counts().sort_index()
+# monthly counts (number of dispense / restock events per month)
+inv_monthly  = inv_cube.rollup('M')['n'].rename('count')
+rest_monthly = rest_cube.rollup('M')['n'].rename('count')
 
 # rolling stats
 inv_rm = inv_monthly.rolling(3).mean()
@@ -312,19 +310,9 @@ print(output_restock)
 
 # Checking for autocorrelation
 
-# 1) Build true monthly‐quantity series
-inv_monthly_qty = (
-    df_inventory
-      .set_index('dispense_date')
-      .resample('ME')['qty_dispensed']
-      .sum()
-)
-rest_monthly_qty = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']
-      .sum()
-)
+# 1) True monthly‐quantity series (month-end index), from the cubes
+inv_monthly_qty  = inv_cube.series('ME')
+rest_monthly_qty = rest_cube.series('ME')
 
 # 2) Compute only quantity‐based autocorrelations at 1, 3, 6 and 9 months
 for name, series in [
@@ -347,19 +335,7 @@ Any ARIMA/SARIMA (or seasonal regression) should include at least a seasonal lag
 import matplotlib.pyplot as plt
 from statsmodels.graphics.tsaplots import plot_acf, plot_pacf
 
-# 1) Build true monthly‐quantity series
-inv_monthly_qty = (
-    df_inventory
-      .set_index('dispense_date')
-      .resample('ME')['qty_dispensed']
-      .sum()
-)
-rest_monthly_qty = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']
-      .sum()
-)
+# 1) inv_monthly_qty / rest_monthly_qty were built from the cubes above
 
 # 2) Determine max lags per series
 max_acf_inv  = min(24, len(inv_monthly_qty)  - 1)
@@ -434,43 +410,44 @@ May reflect supply-chain disruptions mid-year and an end-of-year push to top off
 
 # Step 4 Feature Engineering
 
+# Calendar dimension table: one row per day spanning both feeds, holding the calendar
+# fields, Fourier terms and a US federal holiday flag. Daily tables join it by
+# integer date key instead of recomputing .dt fields and np.sin/np.cos per row.
+from vending_features import CALENDAR_FIELDS, FOURIER_FIELDS, add_calendar_features, calendar_table
+
+calendar = calendar_table(
+    min(df_inventory['dispense_date'].min(), df_restock['restock_date'].min()),
+    max(df_inventory['dispense_date'].max(), df_restock['restock_date'].max()),
+    weekly_order=1, monthly_order=1, holidays='us_federal',
+)
+
 # Create Daily Level Inventory Table
 daily_inventory = (
     df_inventory
-      .groupby(['device_id', df_inventory['dispense_date'].dt.date])
+      .groupby(['device_id', df_inventory['dispense_date'].dt.date], observed=True)
       .agg(qty_dispensed=('qty_dispensed','sum'))
       .reset_index()
       .rename(columns={'dispense_date':'date'})
 )
 
-# Now add calendar fields
-daily_inventory['date']         = pd.to_datetime(daily_inventory['date'])
-daily_inventory['day_of_week']  = daily_inventory['date'].dt.dayofweek        # 0=Mon … 6=Sun
-daily_inventory['is_weekend']   = daily_inventory['day_of_week'].isin([5,6]).astype(int)
-daily_inventory['day_of_month'] = daily_inventory['date'].dt.day
-daily_inventory['month']        = daily_inventory['date'].dt.month
-daily_inventory['quarter']      = daily_inventory['date'].dt.quarter
-daily_inventory['year']         = daily_inventory['date'].dt.year
+# Now add calendar fields (day_of_week 0=Mon … 6=Sun)
+daily_inventory['date'] = pd.to_datetime(daily_inventory['date'])
+add_calendar_features(daily_inventory, calendar, CALENDAR_FIELDS)
 
 print(daily_inventory)
 
 # Create Daily Level Inventory Table
 daily_restock = (
     df_restock
-      .groupby(['device_id', df_restock['restock_date'].dt.date])
+      .groupby(['device_id', df_restock['restock_date'].dt.date], observed=True)
       .agg(total_restocked=('total','sum'))
       .reset_index()
       .rename(columns={'restock_date':'date'})
 )
 
 # Now add calendar fields
-daily_restock['date']         = pd.to_datetime(daily_restock['date'])
-daily_restock['day_of_week']  = daily_restock['date'].dt.dayofweek
-daily_restock['is_weekend']   = daily_restock['day_of_week'].isin([5,6]).astype(int)
-daily_restock['day_of_month'] = daily_restock['date'].dt.day
-daily_restock['month']        = daily_restock['date'].dt.month
-daily_restock['quarter']      = daily_restock['date'].dt.quarter
-daily_restock['year']         = daily_restock['date'].dt.year
+daily_restock['date'] = pd.to_datetime(daily_restock['date'])
+add_calendar_features(daily_restock, calendar, CALENDAR_FIELDS)
 
 print(daily_restock.head())
 print(daily_restock.dtypes)
@@ -489,7 +466,7 @@ import pandas as pd
 daily_inventory = (
     df_inventory
       .assign(date=df_inventory['dispense_date'].dt.normalize())   # extract just the date (no time)
-      .groupby(['device_id', 'date'], as_index=False)
+      .groupby(['device_id', 'date'], as_index=False, observed=True)
       .agg(qty_dispensed=('qty_dispensed', 'sum'))
 )
 
@@ -497,12 +474,21 @@ daily_inventory = (
 daily_restock = (
     df_restock
       .assign(date=df_restock['restock_date'].dt.normalize())
-      .groupby(['device_id', 'date'], as_index=False)
+      .groupby(['device_id', 'date'], as_index=False, observed=True)
       .agg(total_restocked=('total', 'sum'))
 )
 
 # Now both daily_inventory and daily_restock have a true datetime64[ns] column named "date".
 
+# 0C) daily_inventory only has rows for days with dispenses, so a row shift is not a
+#     day shift. The dense panel puts every device on one explicit calendar: zero on
+#     non-dispense days, masked outside each device's first..last dispense day.
+from vending_features import DailyPanel
+
+daily_panel = DailyPanel.from_daily(daily_inventory, 'qty_dispensed', by=('device_id',))
+print('Daily panel (devices x days):', daily_panel.shape,
+      '| zero-dispense active days:', int((daily_panel.values[daily_panel.active] == 0).sum()))
+
 
 # --- 1) Build true monthly‐quantity series from each daily table ---
 
@@ -528,60 +514,20 @@ rest_monthly = (
 
 
 # --- 2) Create lagged and rolling‐window features on the monthly series ---
+# lag_1 / lag_3 / lag_12 and 3- and 12-month rolling mean / std, in one vectorized pass
+from vending_features import add_lag_features, build_lag_features
 
 # 2A) Inventory lags + rolling stats
-inv_monthly['lag_1']       = inv_monthly['dispensed_qty'].shift(1)
-inv_monthly['lag_3']       = inv_monthly['dispensed_qty'].shift(3)
-inv_monthly['lag_12']      = inv_monthly['dispensed_qty'].shift(12)
-
-inv_monthly['roll_mean_3'] = (
-    inv_monthly['dispensed_qty']
-      .rolling(window=3, min_periods=1)
-      .mean()
-)
-inv_monthly['roll_std_3']  = (
-    inv_monthly['dispensed_qty']
-      .rolling(window=3, min_periods=1)
-      .std()
-)
-
-inv_monthly['roll_mean_12'] = (
-    inv_monthly['dispensed_qty']
-      .rolling(window=12, min_periods=1)
-      .mean()
-)
-inv_monthly['roll_std_12']  = (
-    inv_monthly['dispensed_qty']
-      .rolling(window=12, min_periods=1)
-      .std()
-)
+add_lag_features(inv_monthly, 'dispensed_qty', lags=(1, 3, 12), windows=(3, 12))
 
 # 2B) Restock lags + rolling stats
-rest_monthly['lag_1']       = rest_monthly['monthly_restocked_qty'].shift(1)
-rest_monthly['lag_3']       = rest_monthly['monthly_restocked_qty'].shift(3)
-rest_monthly['lag_12']      = rest_monthly['monthly_restocked_qty'].shift(12)
-
-rest_monthly['roll_mean_3'] = (
-    rest_monthly['monthly_restocked_qty']
-      .rolling(window=3, min_periods=1)
-      .mean()
-)
-rest_monthly['roll_std_3']  = (
-    rest_monthly['monthly_restocked_qty']
-      .rolling(window=3, min_periods=1)
-      .std()
-)
+add_lag_features(rest_monthly, 'monthly_restocked_qty', lags=(1, 3, 12), windows=(3, 12))
 
-rest_monthly['roll_mean_12'] = (
-    rest_monthly['monthly_restocked_qty']
-      .rolling(window=12, min_periods=1)
-      .mean()
-)
-rest_monthly['roll_std_12']  = (
-    rest_monthly['monthly_restocked_qty']
-      .rolling(window=12, min_periods=1)
-      .std()
-)
+# 2C) The same features for every (device, sku) monthly series at once,
+#     as a long-format feature matrix (one row per series per month)
+sku_device_features = build_lag_features(inv_cube, 'M', by=('device_id', 'sku'),
+                                          lags=(1, 3, 12), windows=(3, 12))
+print(sku_device_features.head())
 
 
 # --- 3) Merge those monthly features back onto the daily tables ---
@@ -631,54 +577,21 @@ print(daily_restock.columns.tolist())
 
 import numpy as np
 
-# --- Ensure day_of_week and month exist on daily_inventory ---
-# (Recompute them from the 'date' column so we know they’re there.)
-daily_inventory['day_of_week']  = daily_inventory['date'].dt.dayofweek
-daily_inventory['month']        = daily_inventory['date'].dt.month
-
-# Now compute the four cyclical features
-daily_inventory['dow_sin'] = np.sin(2 * np.pi * daily_inventory['day_of_week'] / 7)
-daily_inventory['dow_cos'] = np.cos(2 * np.pi * daily_inventory['day_of_week'] / 7)
-daily_inventory['m_sin']   = np.sin(2 * np.pi * (daily_inventory['month'] - 1) / 12)
-daily_inventory['m_cos']   = np.cos(2 * np.pi * (daily_inventory['month'] - 1) / 12)
+# day_of_week / month and the four cyclical features, looked up from the calendar table
+add_calendar_features(daily_inventory, calendar, ['day_of_week', 'month'] + FOURIER_FIELDS)
 
 print(daily_inventory[['date','day_of_week','month','dow_sin','dow_cos','m_sin','m_cos']].head())
 
-
-# --- Ensure daily_inventory has a column named "date" too ---
-if "date" not in daily_inventory.columns:
-    if "dispense_date" in daily_inventory.columns:
-        daily_inventory = daily_inventory.rename(columns={"dispense_date": "date"})
-    else:
-        raise KeyError("daily_inventory must have either 'date' or 'dispense_date'.")
-
-daily_inventory["date"] = pd.to_datetime(daily_inventory["date"])
-daily_inventory["day_of_week"] = daily_inventory["date"].dt.dayofweek
-daily_inventory["month"]       = daily_inventory["date"].dt.month
-
-daily_inventory["dow_sin"] = np.sin(2 * np.pi * daily_inventory["day_of_week"] / 7)
-daily_inventory["dow_cos"] = np.cos(2 * np.pi * daily_inventory["day_of_week"] / 7)
-daily_inventory["m_sin"]   = np.sin(2 * np.pi * (daily_inventory["month"] - 1) / 12)
-daily_inventory["m_cos"]   = np.cos(2 * np.pi * (daily_inventory["month"] - 1) / 12)
-
-print(daily_inventory[["date","day_of_week","month","dow_sin","dow_cos","m_sin","m_cos"]].head())
-
 # Looking for some insights with new datetime features
 
 # Make sure daily_inventory has day_of_week, is_weekend, day_of_month, month
-daily_inventory['day_of_week']  = daily_inventory['date'].dt.dayofweek     # 0=Mon … 6=Sun
-daily_inventory['is_weekend']   = daily_inventory['day_of_week'].isin([5,6]).astype(int)
-daily_inventory['day_of_month'] = daily_inventory['date'].dt.day
-daily_inventory['month']        = daily_inventory['date'].dt.month
+add_calendar_features(daily_inventory, calendar, ['day_of_week', 'is_weekend', 'day_of_month', 'month'])
 
 # Same for daily_restock:
 if daily_restock.index.name == 'date':
     daily_restock = daily_restock.reset_index()
 
-daily_restock['day_of_week']     = daily_restock['date'].dt.dayofweek
-daily_restock['is_weekend']      = daily_restock['day_of_week'].isin([5,6]).astype(int)
-daily_restock['day_of_month']    = daily_restock['date'].dt.day
-daily_restock['month']           = daily_restock['date'].dt.month
+add_calendar_features(daily_restock, calendar, ['day_of_week', 'is_weekend', 'day_of_month', 'month'])
 
 
 # insights from daily_inventory
@@ -726,21 +639,11 @@ print(daily_restock.head())
 # Trends and Seasonality Analysis: Analyze the total quantity dispensed and restocked over time to identify any visible trends or seasonal patterns.
 
 # Top 20 SKUs dispensed
-sku_totals = (
-    df_inventory
-      .groupby('sku')['qty_dispensed']
-      .sum()
-      .sort_values(ascending=False)
-)
+sku_totals = inv_cube.totals('sku').sort_values(ascending=False)
 print(sku_totals.head(20))
 
 # Top 20 SKUs restocked
-sku_restocked_totals = (
-    df_restock
-      .groupby('device_id')['total']
-      .sum()
-      .sort_values(ascending=False)
-)
+sku_restocked_totals = rest_cube.totals('device_id').sort_values(ascending=False)
 print(sku_restocked_totals.head(20))
 
 """Top SKUs by Total Units Dispensed
@@ -773,25 +676,7 @@ From an inventory‐planning perspective, it may make sense to prioritize foreca
 df_inventory['dispense_date'] = pd.to_datetime(df_inventory['dispense_date'])
 df_restock  ['restock_date']  = pd.to_datetime(df_restock['restock_date'])
 
-# 1) Build monthly‐quantity series
-
-# Inventory (qty_dispensed per month, month‐end index)
-inv_monthly_qty = (
-    df_inventory
-      .set_index('dispense_date')           # ensure 'dispense_date' is datetime64
-      .resample('ME')['qty_dispensed']      # 'ME' = Month End
-      .sum()
-      .sort_index()
-)
-
-# Restock (total restocked per month, month‐end index)
-rest_monthly_qty = (
-    df_restock
-      .set_index('restock_date')            # ensure 'restock_date' is datetime64
-      .resample('ME')['total']              # 'ME' = Month End
-      .sum()
-      .sort_index()
-)
+# 1) Monthly‐quantity series: inv_monthly_qty / rest_monthly_qty from the cubes
 
 
 # 2) Plot raw monthly totals + 3-month rolling statistics
@@ -915,23 +800,10 @@ plt.show()
 
 
 # 3) Build a “monthly_by_sku” DataFrame for those top SKUs
-#    — first create a Year‐Month period column
-df_inventory['year_month'] = df_inventory['dispense_date'].dt.to_period('M')
-
-#    — filter to only keep the top N SKUs
+#    — the cube's month × SKU pivot, keeping only the top N SKU columns
 top_skus = top_sku_totals.index.tolist()
-inv_top = df_inventory[df_inventory['sku'].isin(top_skus)].copy()
-
-#    — group by [year_month, sku], sum qty_dispensed, then unstack so that each column is one SKU
-monthly_by_sku = (
-    inv_top
-      .groupby(['year_month', 'sku'])['qty_dispensed']
-      .sum()
-      .unstack(fill_value=0)
-)
-
-# Convert the index back to Timestamp (month end) for easier plotting on the x‐axis
-monthly_by_sku.index = monthly_by_sku.index.to_timestamp()
+monthly_by_sku = inv_cube.pivot('M', 'sku')
+monthly_by_sku = monthly_by_sku.loc[:, monthly_by_sku.columns.isin(top_skus)]
 
 print("\n=== Monthly Demand for Top SKUs (first few rows) ===")
 print(monthly_by_sku.head())
@@ -1032,34 +904,13 @@ Operationally, prioritizing summer restocking for these top SKUs—and schedulin
 # Correlation Analysis: Explore correlations between the quantity dispensed and restock frequency or cost.
 # This is
 
-# 1) Build a true “monthly quantity dispensed” series (month‐end index)
-inv_monthly_qty = (
-    df_inventory
-      .set_index('dispense_date')             # ensure datetime index
-      .resample('ME')['qty_dispensed']        # ‘ME’ = month‐end
-      .sum()
-      .sort_index()
-)
+# 1) “monthly quantity dispensed” series (month‐end index): inv_monthly_qty from the cube
 
-# 2) Build a “monthly restock frequency” series (count of rows per month)
-rest_monthly_freq = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']                # we’re simply counting rows, so pick any column
-      .count()
-      .rename('restock_frequency')
-      .sort_index()
-)
+# 2) “monthly restock frequency” series (count of restock rows per month)
+rest_monthly_freq = rest_cube.series('ME', stat='count').rename('restock_frequency')
 
-# 3) Build a “monthly restock cost” series (sum of total$ per month)
-rest_monthly_cost = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']
-      .sum()
-      .rename('restock_cost')
-      .sort_index()
-)
+# 3) “monthly restock cost” series (sum of total$ per month)
+rest_monthly_cost = rest_cube.series('ME').rename('restock_cost')
 
 # 4) Merge all three into one DataFrame (outer‐join to keep months that appear only in one series)
 monthly = (
@@ -1097,33 +948,7 @@ Implication for Demand–Supply Timing
 
 # Corrleation analysis with a 1 month lag on restock
 
-# 1) build the three monthly series (exactly as you already have)
-inv_monthly_qty   = (
-    df_inventory
-      .set_index('dispense_date')
-      .resample('ME')['qty_dispensed']
-      .sum()
-      .sort_index()
-)
-
-rest_monthly_freq = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']
-      .count()
-      .rename('restock_frequency')
-      .sort_index()
-)
-
-rest_monthly_cost = (
-    df_restock
-      .set_index('restock_date')
-      .resample('ME')['total']
-      .sum()
-      .rename('restock_cost')
-      .sort_index()
-)
-
+# 1) reuse the three monthly series built above
 monthly = pd.concat(
     [inv_monthly_qty.rename('dispensed_qty'),
      rest_monthly_freq,
@@ -1247,20 +1072,9 @@ December peaks at approximately 1.23 times the annual average, indicating a stro
 
 # Demand Variability by SKU: Investigate the variability in demand for each SKU over time to identify high-variance items that may require special attention in inventory planning.
 
-# 1) Create “year_month” column (PeriodIndex) for df_inventory
-df_inventory['year_month'] = df_inventory['dispense_date'].dt.to_period('M')
-
-# 2) Build a “monthly_by_sku_all” DataFrame: index = year_month, columns = SKUs,
-#    values = total qty_dispensed for that SKU in that month (fill missing with 0)
-monthly_by_sku_all = (
-    df_inventory
-      .groupby(['year_month', 'sku'])['qty_dispensed']
-      .sum()
-      .unstack(fill_value=0)
-)
-
-# 3) Convert the index back to timestamps (month end) for convenience
-monthly_by_sku_all.index = monthly_by_sku_all.index.to_timestamp()
+# 1)-3) “monthly_by_sku_all”: index = year_month, columns = SKUs,
+#    values = total qty_dispensed for that SKU in that month (missing filled with 0)
+monthly_by_sku_all = inv_cube.pivot('M', 'sku')
 
 # 4) Compute per‐SKU summary statistics over all months:
 #    - mean month‐to‐month demand
@@ -1313,20 +1127,9 @@ Bottom line: The highest‐CV SKUs are either ultra‐low‐volume “one‐off
 
 # Seasonality in SKU Demand: Perform a seasonality analysis for individual SKUs to discover any cyclical demand patterns, which can inform restocking strategies.
 
-# 1) (Re)build a monthly‐SKU pivot table if you don’t already have one.
-#    We did this for the top‐10 SKUs earlier; here we’ll do it for all SKUs.
-
-df_inventory['year_month'] = df_inventory['dispense_date'].dt.to_period('M')
-
-monthly_all_skus = (
-    df_inventory
-      .groupby(['year_month', 'sku'])['qty_dispensed']
-      .sum()
-      .unstack(fill_value=0)
-)
-
-# Convert the index back to a Timestamp at month end for plotting convenience
-monthly_all_skus.index = monthly_all_skus.index.to_timestamp()
+# 1) Monthly‐SKU pivot for all SKUs (a fresh copy of the cube's pivot,
+#    since we add a helper column below)
+monthly_all_skus = inv_cube.pivot('M', 'sku')
 
 # 2) Add a “month_of_year” column (1–12) based on that index
 monthly_all_skus['month_of_year'] = monthly_all_skus.index.month
@@ -1453,7 +1256,7 @@ if 'daily_inventory' not in globals() or 'date' not in daily_inventory.columns:
     # Rebuild daily_inventory exactly as before:
     daily_inventory = (
         df_inventory
-          .groupby(['device_id', df_inventory['dispense_date'].dt.date])
+          .groupby(['device_id', df_inventory['dispense_date'].dt.date], observed=True)
           .agg(qty_dispensed=('qty_dispensed', 'sum'))
           .reset_index()
           .rename(columns={'dispense_date':'date'})
@@ -1464,16 +1267,12 @@ if 'daily_inventory' not in globals() or 'date' not in daily_inventory.columns:
 # 1) Count distinct active days per device
 active_days_by_device = (
     daily_inventory
-      .groupby('device_id')['date']
+      .groupby('device_id', observed=True)['date']
       .nunique()
 )
 
-# 2) Compute total quantity dispensed per device (from the raw df_inventory)
-total_dispensed_by_device = (
-    df_inventory
-      .groupby('device_id')['qty_dispensed']
-      .sum()
-)
+# 2) Total quantity dispensed per device (from the inventory cube)
+total_dispensed_by_device = inv_cube.totals('device_id')
 
 # 3) Compute average quantity dispensed per active day
 #    We must align the two series by device_id index
@@ -1535,3 +1334,429 @@ In terms of average throughput (units per active day), device_6726f2a054f54836aa
 
 The narrow range (≈85–99 units/day) indicates no severely underused machine—all machines are utilized at a fairly similar rate, though device_6726f2a054f54836aaabe8c7643286bc is marginally busier than the others.
 """
+
+# Step 5 Modeling
+
+# 5a. SKU-level SARIMA forecasts
+# One SARIMAX per (device, sku) monthly series — AR(1) plus a 12-month seasonal AR term,
+# as the ACF/PACF section suggests — fitted in batches across worker processes.
+# The registry keeps each fit's parameters and end state: an unchanged series is only
+# re-filtered, a series that gained new months is filtered forward from its stored state.
+from vending_features import series_matrix
+from vending_forecast import ModelRegistry, forecast_series
+
+FORECAST_HORIZON = 6
+
+model_registry = ModelRegistry('/content/.vending_models')
+
+series_keys, series_periods, series_values = series_matrix(inv_cube, 'M', by=('device_id', 'sku'))
+sku_forecasts = forecast_series(
+    series_keys, series_periods, series_values,
+    horizon=FORECAST_HORIZON, order=(1, 0, 0), seasonal_order=(1, 0, 0, 12),
+    registry=model_registry,
+)
+
+print(sku_forecasts.head(FORECAST_HORIZON))
+print('\nFit status per series:\n', sku_forecasts.drop_duplicates(['device_id', 'sku'])['status'].value_counts())
+print('\nFit mode per series:\n', sku_forecasts.drop_duplicates(['device_id', 'sku'])['fit_mode'].value_counts())
+
+# 5b. Per-series order selection
+# Instead of one hand-picked order for every SKU, search (p,d,q)(P,D,Q,12) per series by AIC.
+# Each search starts from the series' own ACF/PACF cut-offs and steps to better neighbours,
+# skipping candidates that are too large for 25 months, non-stationary fits, and giving up
+# after repeated convergence failures.
+from vending_forecast import select_orders
+
+sku_orders = select_orders(series_keys, series_periods, series_values, criterion='aic')
+
+print(sku_orders[['device_id', 'sku', 'seed_order', 'order', 'seasonal_order', 'aic', 'fitted', 'status']].head(10))
+print('\nSelected orders:\n', sku_orders.groupby(['order', 'seasonal_order'], dropna=False).size().sort_values(ascending=False).head(10))
+
+selected = sku_orders['status'].eq('ok').to_numpy()
+sku_forecasts_selected = forecast_series(
+    series_keys[selected], series_periods, series_values[selected],
+    horizon=FORECAST_HORIZON,
+    order=sku_orders.loc[selected, 'order'].tolist(),
+    seasonal_order=sku_orders.loc[selected, 'seasonal_order'].tolist(),
+    registry=model_registry,
+)
+print(sku_forecasts_selected.head(FORECAST_HORIZON))
+
+# 5c. Global gradient-boosted model
+# One model for every (device, sku) daily series instead of one fit per series: the
+# daily lags / rolling stats, calendar and Fourier columns and the interned device_id /
+# sku codes, stacked into a single feature matrix and scored in one batch call.
+from vending_forecast import GlobalDemandModel
+
+GLOBAL_HOLDOUT_DAYS = 28
+
+# daily_inventory per (device_id, sku, date), on the dense zero-filled daily calendar
+daily_sku_inventory = (
+    df_inventory
+      .assign(date=df_inventory['dispense_date'].dt.normalize())
+      .groupby(['device_id', 'sku', 'date'], as_index=False, observed=True)
+      .agg(qty_dispensed=('qty_dispensed', 'sum'))
+)
+sku_daily_panel = DailyPanel.from_daily(daily_sku_inventory, 'qty_dispensed', by=('device_id', 'sku'))
+
+# the calendar must also cover the forecast days
+forecast_calendar = calendar_table(
+    calendar['date'].iloc[0], sku_daily_panel.dates[-1] + pd.Timedelta(days=GLOBAL_HOLDOUT_DAYS),
+    weekly_order=1, monthly_order=1, holidays='us_federal',
+)
+
+# hold out the last four weeks, score every series' one-step-ahead prediction at once
+global_model = GlobalDemandModel().fit(
+    sku_daily_panel, forecast_calendar,
+    until=sku_daily_panel.dates[-GLOBAL_HOLDOUT_DAYS - 1],
+)
+one_step = global_model.predict(sku_daily_panel, forecast_calendar)
+holdout = sku_daily_panel.active.copy()
+holdout[:, :-GLOBAL_HOLDOUT_DAYS] = False
+holdout_wape = (np.abs(one_step[holdout] - sku_daily_panel.values[holdout]).sum()
+                / sku_daily_panel.values[holdout].sum())
+print('Global model holdout WAPE (one-step, last %d days): %.3f' % (GLOBAL_HOLDOUT_DAYS, holdout_wape))
+
+# refit on all days and forecast the next four weeks for every series
+global_model.fit(sku_daily_panel, forecast_calendar)
+global_forecasts = global_model.forecast(sku_daily_panel, forecast_calendar, horizon=GLOBAL_HOLDOUT_DAYS)
+print(global_forecasts.head(7))
+print('\nForecast units over the next %d days by device:\n' % GLOBAL_HOLDOUT_DAYS,
+      global_forecasts.groupby('device_id', observed=True)['forecast'].sum())
+
+# 5d. Intermittent-demand SKUs
+# The demand-variability section found sporadic SKUs (mean ≈ 0.08/month, CV ≈ 5) that ARIMA
+# fits poorly. Classify every series by average inter-demand interval (ADI) and the CV² of
+# its non-zero months, and send the intermittent / lumpy / gone-quiet ones to Croston, SBA
+# or TSB, computed in one NumPy recurrence over all of them.
+from vending_forecast import classify_demand, forecast_intermittent
+
+demand_classes = classify_demand(series_keys, series_values)
+print(demand_classes['demand_class'].value_counts())
+print('\nRouting:\n', demand_classes['method'].value_counts())
+
+# the highest-CV series with their routing; sku_variability pools each SKU over the fleet,
+# so measure the CV per (device_id, sku) series like the routing and join on both keys
+series_variability = series_keys.assign(mean=series_values.mean(axis=1),
+                                        std=series_values.std(axis=1, ddof=1))
+series_variability['cv'] = series_variability['std'] / series_variability['mean']
+print(series_variability.sort_values('cv', ascending=False).head(10).merge(
+    demand_classes[['device_id', 'sku', 'adi', 'cv2', 'demand_class', 'method']],
+    on=['device_id', 'sku'], how='left'))
+
+routed = demand_classes['method'].ne('sarima').to_numpy()
+intermittent_forecasts = forecast_intermittent(
+    series_keys[routed], series_periods, series_values[routed],
+    horizon=FORECAST_HORIZON, method=demand_classes.loc[routed, 'method'],
+)
+print(intermittent_forecasts.drop_duplicates(['device_id', 'sku']))
+
+# 5e. ABC/XYZ segmentation
+# sku_totals ranks SKUs by volume and sku_variability by CV; combine both into ABC (80/15/5%
+# of volume) × XYZ (CV ≤ 0.5 / ≤ 1.0 / above) for every SKU and (device, sku) series, saved
+# next to the other caches. The routing table says which model and refit cadence each
+# series gets: heavy models and monthly refits for AX, cheap methods for CZ.
+from vending_forecast import SegmentIndex
+
+segment_index = SegmentIndex.from_cube(inv_cube, 'M')
+segment_index.save('/content/.vending_segments')
+
+print('SKUs per ABC/XYZ cell:\n', segment_index.matrix('sku'))
+
+series_routing = segment_index.routing('device_sku')
+print(series_routing[['device_id', 'sku', 'volume', 'cv', 'segment', 'model', 'refit', 'refit_every']].head(10))
+print('\nSeries per model:\n', series_routing['model'].value_counts())
+
+# 5f. Backtesting
+# Rolling-origin (expanding window) cross-validation: each fold trains on the history up to
+# an origin and forecasts the next periods; folds run in parallel and MAE / RMSE / MASE /
+# WAPE / bias are computed per series in one pass over all folds.
+from vending_forecast import backtest
+
+# monthly: 13 months of training, 3-month horizon, origins every 3 months
+monthly_backtests = pd.concat([
+    backtest(series_keys, series_periods, series_values, name, horizon=3, initial=13, step=3)
+    for name in ('naive', 'seasonal_naive', 'croston', 'sba', 'tsb', 'sarima')
+], ignore_index=True)
+print('Monthly backtest, median over series:\n',
+      monthly_backtests.groupby('forecaster')[['mae', 'rmse', 'mase', 'wape', 'bias']].median())
+
+# daily: the last 12 weeks as three 4-week folds, MASE against a weekly naive
+daily_keys, daily_periods, daily_values = series_matrix(inv_cube, 'D', by=('device_id', 'sku'))
+daily_backtests = pd.concat([
+    backtest(daily_keys, daily_periods, daily_values, 'seasonal_naive', horizon=28,
+             initial=len(daily_periods) - 84, step=28, mase_season=7, season=7),
+    backtest(daily_keys, daily_periods, daily_values, 'global', horizon=28,
+             initial=len(daily_periods) - 84, step=28, mase_season=7, calendar=forecast_calendar),
+], ignore_index=True)
+print('\nDaily backtest, median over series:\n',
+      daily_backtests.groupby('forecaster')[['mae', 'rmse', 'mase', 'wape', 'bias']].median())
+
+# 5g. Safety stock and reorder points
+# Each device's review period is its measured gap between restock visits, and the driver
+# refills on the visit, so there is no separate delivery lead time. Demand is each series'
+# SARIMA forecast; series whose fit was rejected (constant, too short, non-stationary) fall
+# back to their trailing 12-month mean, as in 5n, so no SKU drops out of the plan. The error
+# is the backtest WAPE scaled by each month's forecast, which is what raises safety stock in
+# the busy months and lowers it in the quiet ones.
+from vending_inventory import inventory_policy, restock_lead_times
+
+restock_lead = restock_lead_times(df_restock)
+print(restock_lead)
+
+trailing_mean = pd.Series(series_values[:, -12:].mean(axis=1), index=pd.MultiIndex.from_frame(series_keys))
+policy_forecasts = sku_forecasts.copy()
+policy_forecasts['forecast'] = policy_forecasts['forecast'].fillna(pd.Series(
+    trailing_mean.reindex(pd.MultiIndex.from_frame(policy_forecasts[['device_id', 'sku']])).to_numpy(),
+    index=policy_forecasts.index))
+
+sarima_errors = monthly_backtests[monthly_backtests['forecaster'].eq('sarima')]
+restock_policy = inventory_policy(policy_forecasts, sarima_errors, restock_lead, service_level=0.95)
+print(restock_policy[['device_id', 'sku', 'period', 'forecast', 'wape', 'review_days',
+                      'safety_stock', 'reorder_point', 'order_up_to']].head(FORECAST_HORIZON))
+print('\nFleet safety stock by forecast month:\n',
+      restock_policy.groupby('period')['safety_stock'].sum().round(0))
+
+# 5h. Restock runs
+# Until there is a measured on-hand level, assume every SKU was topped up to its order-up-to
+# level at the device's last restock visit and has been drawn down at the forecast rate
+# since. Each device is due the day before any of its SKUs passes a 5% stockout risk;
+# devices due within two days of a run ride along with it. The route capacity (stops per
+# run) and the run days are read off the restock log, not chosen for the plan.
+from vending_inventory import plan_restocks
+
+PLAN_DAYS = 28
+
+# the plan starts after both feeds end: the restock log runs ~3 weeks past the last dispense
+plan_start = max(df_inventory['dispense_date'].max(), df_restock['restock_date'].max()).normalize() \
+    + pd.Timedelta(days=1)
+last_restock = df_restock.groupby('device_id', observed=True)['restock_date'].max().dt.normalize()
+
+restock_items = restock_policy[restock_policy['step'].eq(1)].copy()
+days_since_restock = (plan_start - last_restock.reindex(restock_items['device_id'])).dt.days.to_numpy()
+days_since_restock = np.maximum(days_since_restock, 0)
+restock_items['on_hand'] = np.maximum(
+    restock_items['order_up_to'] - restock_items['daily_demand'] * days_since_restock, 0.0)
+
+visit_days = pd.DataFrame({'device_id': df_restock['device_id'],
+                           'date': df_restock['restock_date'].dt.normalize()}).drop_duplicates()
+route_stops = int(visit_days.groupby('date').size().max())
+weekday_share = visit_days['date'].dt.dayofweek.value_counts(normalize=True)
+run_weekdays = tuple(sorted(weekday_share.index[weekday_share >= 0.05]))
+print('Route capacity: %d stops per run, run days %s' % (route_stops, run_weekdays))
+
+restock_runs, restock_visits = plan_restocks(restock_items, plan_start, horizon_days=PLAN_DAYS,
+                                             risk=0.05, max_stops=route_stops, max_pull_days=2,
+                                             visit_weekdays=run_weekdays)
+print(restock_runs.head(10))
+print('\nRuns: %d, device visits: %d, late visits: %d' % (
+    len(restock_runs), len(restock_visits), restock_visits['late'].sum()))
+print('\nVisits per device:\n', restock_visits.groupby('device_id', observed=True).size())
+
+# the historical baseline: the last four weeks of actual visits, replayed over the plan window
+# (a 28-day shift keeps every visit on its weekday)
+historical_visits = (
+    visit_days[visit_days['date'] >= plan_start - pd.Timedelta(days=PLAN_DAYS)]
+      .assign(date=lambda f: f['date'] + pd.Timedelta(days=PLAN_DAYS))
+)
+
+# 5i. Stockout risk
+# 2,000 demand paths per (device, sku) over the plan's 28 days, drawn around the forecast
+# daily rate with the forecast error, run against the estimated on-hand and a visit schedule
+# (each visit tops the device's SKUs up to their order-up-to level) — once for the plan and
+# once for the historical schedule, to show what the plan saves and what it risks.
+from vending_inventory import simulate_stockouts, visit_mask
+
+
+def schedule_risk(visits):
+    return simulate_stockouts(
+        restock_items[['device_id', 'sku']],
+        restock_items['on_hand'].to_numpy(),
+        np.repeat(restock_items['daily_demand'].to_numpy()[:, None], PLAN_DAYS, axis=1),
+        demand_std=restock_items['daily_std'].to_numpy(),
+        restock=visit_mask(restock_items, visits, plan_start, PLAN_DAYS),
+        target=restock_items['order_up_to'].to_numpy(),
+        n_paths=2000,
+    )
+
+
+stockout_risk = schedule_risk(restock_visits)
+historical_risk = schedule_risk(historical_visits)
+print(stockout_risk.sort_values('stockout_prob', ascending=False).head(10))
+
+schedule_comparison = pd.DataFrame({
+    schedule: {
+        'visits':                 len(visits),
+        'run_days':               visits['date'].nunique(),
+        'mean_stockout_prob':     risk['stockout_prob'].mean(),
+        'skus_likely_to_run_out': int((risk['stockout_prob'] > 0.5).sum()),
+        'expected_lost_units':    risk['expected_shortage'].sum(),
+        'fill_rate':              1 - risk['expected_shortage'].sum() / risk['expected_demand'].sum(),
+    }
+    for schedule, visits, risk in (('plan', restock_visits, stockout_risk),
+                                   ('historical', historical_visits, historical_risk))
+})
+print('\nPlan vs the historical schedule over %d days:\n' % PLAN_DAYS, schedule_comparison.round(3))
+print('\nVisits saved: %d' % (len(historical_visits) - len(restock_visits)))
+
+# 5j. On-hand ledger
+# Neither feed records stock counts, so the level per device is implied: opening stock plus
+# cumulative restocks minus cumulative dispenses, from the first restock on. Restock totals
+# are dollars, so each device's totals are scaled to balance its dispensed units over the
+# year, and the opening level is the smallest that never goes negative. The (device × day)
+# array answers point-in-time queries by position and is saved with the other caches.
+from vending_inventory import InventoryLedger
+
+ledger = InventoryLedger.from_cubes(inv_cube, rest_cube, restock_scale='balance')
+ledger.save('/content/.vending_ledger.npz')
+
+print('Ledger (devices x days):', ledger.shape, ledger.dates[0].date(), '->', ledger.dates[-1].date())
+# the ledger ends on the last day both feeds cover; past it there are restocks but no dispenses
+print('\nOn hand at the end of the ledger:\n', ledger.current().round(0))
+
+restock_cycles = ledger.cycles()
+print(restock_cycles.groupby('device_id', observed=True)[['days_since_restock', 'dispensed_since_restock']].max())
+
+# 5k. Per-series diagnostics
+# The stationarity and autocorrelation checks above ran on the raw transactions and on the
+# two fleet totals only. Run them on every (device, sku) monthly series: ACF/PACF to lag 12
+# from one FFT over the whole series × month block, and ADF and KPSS fitted across worker
+# processes. The seasonal strength of a 12-month decomposition needs three full cycles to
+# mean anything (on two, even white noise scores ~0.97), so with 25 months it is NaN and
+# stays out of the routing table until the history is long enough.
+from vending_diagnostics import series_diagnostics
+
+series_diag, series_acf, series_pacf = series_diagnostics(series_keys, series_values, nlags=12, period=12)
+print(series_diag[['device_id', 'sku', 'adf_pvalue', 'kpss_pvalue', 'stationary',
+                   'acf_1', 'acf_12', 'pacf_1']].head(10))
+print('\nStationary series (ADF and KPSS agree): %d of %d' % (series_diag['stationary'].sum(), len(series_diag)))
+
+# next to the routing table; the ACF/PACF blocks can seed select_orders(acf_values=..., pacf_values=...)
+series_routing = series_routing.merge(
+    series_diag[['device_id', 'sku', 'stationary', 'acf_1', 'acf_12']],
+    on=['device_id', 'sku'], how='left')
+print(series_routing.groupby('model')[['acf_1', 'acf_12']].median())
+
+# 5l. Per-SKU seasonal decomposition
+# The per-SKU seasonal profiles above are plain calendar-month means, so trend leaks into
+# them (the 2022 peak and the early-2023 trough land on specific months). Decompose every
+# column of monthly_by_sku_all instead: the classical path in one vectorized call, robust
+# STL across worker processes, and read each SKU's profile off its seasonal component.
+# With 25 months each calendar month rests on two observations, so these profiles are
+# descriptive only; Decomposition.strength() stays NaN until there are three full cycles,
+# and the SKUs are not ranked on it here.
+from vending_diagnostics import decompose_pivot
+
+sku_decomp = decompose_pivot(monthly_by_sku_all, period=12, method='classical')
+sku_decomp_stl = decompose_pivot(monthly_by_sku_all, period=12, method='stl', robust=True)
+
+sku_seasonal_profiles = sku_decomp_stl.seasonal_profile()
+print(sku_seasonal_profiles[top_10].round(1))
+
+plt.figure(figsize=(8, 5))
+for sku in top_10:
+    plt.plot(sku_seasonal_profiles.index, sku_seasonal_profiles[sku], marker='o', label=sku)
+plt.axhline(0.0, color='gray', linestyle='--', linewidth=1)
+plt.title("STL Seasonal Component by Month\n(Top 10 SKUs)")
+plt.xlabel("Calendar Month (1=Jan ... 12=Dec)")
+plt.xticks(range(1, 13))
+plt.ylabel("Seasonal Effect (units)")
+plt.legend(title="SKU", bbox_to_anchor=(1.02, 1), loc='upper left')
+plt.tight_layout()
+plt.show()
+
+# 5m. Seasonal-profile clusters
+# Cluster the 82 STL seasonal profiles by shape (k-means on unit-length vectors) and index
+# them for nearest-neighbour lookup. SKUs with fewer than 12 demand months borrow their
+# cluster's volume-weighted seasonal index instead of trusting their own, and forecasting
+# can run one SARIMA per cluster total instead of one per SKU.
+from vending_diagnostics import SeasonalProfileIndex
+from vending_forecast import forecast_pivot
+
+profile_index = SeasonalProfileIndex.from_profiles(
+    sku_seasonal_profiles, levels=monthly_by_sku_all.mean(), n_clusters=6, method='kmeans')
+profile_index.save('/content/.vending_profiles')
+
+sku_clusters = profile_index.table()
+print(sku_clusters['cluster'].value_counts().sort_index())
+print(profile_index.cluster_index.round(2))
+
+# the SKUs whose seasonal shape is closest to the top seller's
+print(profile_index.most_similar(sku_seasonal_profiles[[top_10[0]]], k=5))
+
+sparse_skus = monthly_by_sku_all.columns[(monthly_by_sku_all > 0).sum() < 12]
+borrowed_index = profile_index.borrow(sku_seasonal_profiles[sparse_skus])
+print('\nSparse SKUs borrowing a cluster seasonal index:', len(sparse_skus))
+
+cluster_totals = monthly_by_sku_all.T.groupby(sku_clusters['cluster']).sum().T
+cluster_totals.columns.name = 'cluster'
+cluster_forecasts = forecast_pivot(cluster_totals, horizon=FORECAST_HORIZON)
+print(cluster_forecasts[['cluster', 'period', 'forecast', 'status']].head(FORECAST_HORIZON))
+
+# 5n. Hierarchical reconciliation
+# Forecast every node of the hierarchy (fleet, device, SKU and each device × SKU series),
+# then reconcile so the SKU forecasts add up to the device and fleet forecasts. The summing
+# matrix is sparse; MinT weights each node by its backtest error variance, so the smooth
+# fleet and device totals pull the noisy SKU forecasts into line.
+from vending_forecast import Hierarchy
+
+hierarchy = Hierarchy(series_keys)
+node_values = hierarchy.aggregate(series_values)
+
+node_forecasts = forecast_series(
+    hierarchy.nodes, series_periods, node_values,
+    horizon=FORECAST_HORIZON, order=(1, 0, 0), seasonal_order=(1, 0, 0, 12),
+)
+node_backtests = backtest(hierarchy.nodes, series_periods, node_values, 'sarima',
+                          horizon=3, initial=13, step=3)
+
+# nodes without a usable SARIMA fit (constant, too short, non-stationary) fall back to
+# their last-12-month mean, so every node has a base forecast to reconcile
+base_forecasts = node_forecasts['forecast'].to_numpy().reshape(len(hierarchy.nodes), FORECAST_HORIZON)
+fallback = np.repeat(node_values[:, -12:].mean(axis=1, keepdims=True), FORECAST_HORIZON, axis=1)
+base_forecasts = np.where(np.isfinite(base_forecasts), base_forecasts, fallback)
+
+reconciled = {
+    method: hierarchy.reconcile(base_forecasts, method, weights=node_backtests['rmse'].to_numpy() ** 2,
+                                history=series_values)
+    for method in ('bottom_up', 'top_down', 'ols', 'mint')
+}
+forecast_periods = pd.period_range(series_periods[-1] + 1, periods=FORECAST_HORIZON, freq=series_periods.freq)
+fleet_reconciled = pd.DataFrame(
+    {'base': base_forecasts[0], **{m: r[0] for m, r in reconciled.items()}}, index=forecast_periods)
+print('Fleet forecast by reconciliation method:\n', fleet_reconciled.round(0))
+
+device_rows = hierarchy.nodes['level'].eq('device').to_numpy()
+device_reconciled = hierarchy.nodes.loc[device_rows, ['device_id']].assign(
+    base=base_forecasts[device_rows].sum(axis=1), mint=reconciled['mint'][device_rows].sum(axis=1))
+print('\nDevice totals over the horizon, base vs MinT:\n', device_reconciled.round(0))
+
+# 5o. Dispense / restock lead-lag
+# The lagged correlation above shifts restock cost by hand on fleet totals, and its sign is
+# easy to misread. lead_lag() computes the whole cross-correlation function for every device
+# in one FFT: ccf at lag k is corr(dispensed(t), restock visits(t + k)), so a positive peak lag
+# is how many periods restocking trails dispensing — lag +1 is the .shift(-1) alignment. Only
+# the window covered by both tables is used, and the band is the ±1.96/sqrt(n) white-noise limit.
+from vending_diagnostics import lead_lag
+
+restock_lead_lag = {}
+for freq, max_lag in (('D', 14), ('W', 8), ('M', 3)):
+    frame, ccf_lags, ccf_values = lead_lag(
+        series_matrix(inv_cube, freq, by=('device_id',)),
+        series_matrix(rest_cube, freq, by=('device_id',), stat='count'),
+        max_lag=max_lag,
+    )
+    restock_lead_lag[freq] = frame, ccf_lags, ccf_values
+    print(f'\n=== Dispense vs restock visits, freq={freq}, lags ±{max_lag} ===')
+    print(frame[['device_id', 'n_periods', 'ccf_0', 'peak_lag', 'peak_ccf', 'band', 'significant']].round(3))
+
+# the weekly cross-correlation function per device, with its confidence band
+weekly_frame, weekly_lags, weekly_ccf = restock_lead_lag['W']
+fig, axes = plt.subplots(1, len(weekly_frame), figsize=(4 * len(weekly_frame), 3), sharey=True)
+for ax, (_, row), ccf_row in zip(np.atleast_1d(axes), weekly_frame.iterrows(), weekly_ccf):
+    ax.bar(weekly_lags, ccf_row)
+    ax.axhspan(-row['band'], row['band'], color='grey', alpha=0.2)
+    ax.set_title(str(row['device_id'])[:15], fontsize=9)
+    ax.set_xlabel('lag (weeks, + = restock after dispense)')
+plt.tight_layout()
+plt.show()
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""Aggregation and feature-building helpers shared by the analysis sections.
+
+The dispense and restock frames are reduced once to a (device, SKU, day)
+cube; every weekly, monthly, per-SKU or fleet-wide view is a cached roll-up
+of that cube rather than a fresh groupby over the raw rows. Lag and rolling
+features are computed for all series at once on a dense (series × time)
+NumPy block, and the daily tables can be laid out as a zero-filled panel on
+an explicit calendar so that lags never skip over non-dispense days.
+Calendar and Fourier fields live in one small per-date table that feature
+frames join by integer date key.
+"""
+
+import numpy as np
+import pandas as pd
+
+# period aliases accepted by AggregationCube
+_PERIODS = {'D': 'D', 'W': 'W', 'M': 'M', 'ME': 'M'}
+
+
+class AggregationCube:
+    """Memoized sums and row counts over (dims..., day).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Cleaned dispense or restock frame.
+    value_col : str
+        Column to sum ('qty_dispensed' or 'total').
+    date_col : str
+        Datetime column ('dispense_date' or 'restock_date').
+    dims : tuple of str
+        Key columns present in df, finest first-class level of the cube.
+
+    Every roll-up is cached on first use and built from the cheapest cached
+    parent: (freq, dims) from the daily base, and (freq, subset of dims)
+    from (freq, dims).
+    """
+
+    def __init__(self, df, value_col='qty_dispensed', date_col='dispense_date',
+                 dims=('device_id', 'sku')):
+        self.value_col = value_col
+        self.date_col = date_col
+        self.dims = tuple(d for d in dims if d in df.columns)
+        self._cache = {}
+
+        keys = [df[d] for d in self.dims] + [df[date_col].dt.normalize().rename('date')]
+        self.base = (
+            df.groupby(keys, observed=True)[value_col]
+              .agg(['sum', 'count'])
+              .rename(columns={'sum': value_col, 'count': 'n'})
+        )
+
+    # -- roll-ups -------------------------------------------------------------
+
+    def rollup(self, freq='M', by=()):
+        """Sums and counts per (period, *by), indexed by a Period level named 'period'.
+
+        freq='D' keeps days, 'W' weeks (ending Sunday), 'M' calendar months.
+        """
+        freq = _PERIODS[freq]
+        by = tuple(by)
+        key = (freq, by)
+        if key in self._cache:
+            return self._cache[key]
+
+        if by == self.dims:
+            base = self.base.reset_index()
+            period = base['date'].dt.to_period(freq).rename('period')
+            out = base.groupby([period] + [base[d] for d in by], observed=True)[[self.value_col, 'n']].sum()
+        else:
+            unknown = set(by) - set(self.dims)
+            if unknown:
+                raise KeyError('not a cube dimension: %s' % sorted(unknown))
+            parent = self.rollup(freq, self.dims)
+            out = parent.groupby(level=['period', *by], observed=True).sum()
+
+        self._cache[key] = out
+        return out
+
+    def totals(self, by):
+        """All-time sums per id, e.g. sku_totals or total dispensed per device."""
+        key = ('total', by)
+        if key not in self._cache:
+            self._cache[key] = (
+                self.rollup('M', (by,))[self.value_col]
+                  .groupby(level=by, observed=True)
+                  .sum()
+            )
+        return self._cache[key]
+
+    def series(self, freq='ME', stat='sum'):
+        """Fleet-wide series on a contiguous period-end index, zero-filled.
+
+        Same shape and names as ``df.set_index(date_col).resample(freq)[value_col].sum()``
+        (or ``.count()`` with stat='count'), e.g. inv_monthly_qty.
+        """
+        key = ('series', freq, stat)
+        if key in self._cache:
+            return self._cache[key]
+
+        col = self.value_col if stat == 'sum' else 'n'
+        fleet = self.rollup(freq, ())[col]
+        period_index = pd.period_range(fleet.index.min(), fleet.index.max(),
+                                       freq=fleet.index.freq)
+        fleet = fleet.reindex(period_index, fill_value=0)
+        index = fleet.index.to_timestamp(how='end').normalize()
+        out = pd.Series(fleet.to_numpy(), index=pd.DatetimeIndex(index, freq=freq,
+                                                                 name=self.date_col),
+                        name=self.value_col)
+        self._cache[key] = out
+        return out
+
+    def pivot(self, freq='M', by='sku'):
+        """Wide (period × id) table of sums, zero-filled, e.g. monthly_by_sku_all.
+
+        The index holds period-start timestamps named 'year_month', matching
+        ``groupby(['year_month', by]).sum().unstack(fill_value=0)`` followed
+        by ``index.to_timestamp()``. A fresh copy is returned each call, so
+        callers may add helper columns.
+        """
+        key = ('pivot', _PERIODS[freq], by)
+        if key not in self._cache:
+            wide = self.rollup(freq, (by,))[self.value_col].unstack(fill_value=0)
+            wide.index = wide.index.to_timestamp()
+            wide.index.name = 'year_month'
+            self._cache[key] = wide
+        return self._cache[key].copy()
+
+
+# ---------------------------------------------------------------------------
+# Dense series matrix and vectorized lag / rolling features
+# ---------------------------------------------------------------------------
+
+DEFAULT_LAGS = (1, 3, 12)
+DEFAULT_WINDOWS = (3, 12)
+
+
+def series_matrix(cube, freq='M', by=('device_id', 'sku'), stat='sum'):
+    """Every (by...) series of a cube as one zero-filled (series × period) array.
+
+    Returns (keys, periods, values): keys is a DataFrame with one row per
+    series, periods a contiguous PeriodIndex shared by all series, and
+    values a float64 array of shape (len(keys), len(periods)). stat='count'
+    gives row counts (e.g. restock visits) instead of sums.
+    """
+    col = cube.rollup(freq, by)[cube.value_col if stat == 'sum' else 'n']
+    period_level = col.index.get_level_values('period')
+    periods = pd.period_range(period_level.min(), period_level.max(), freq=period_level.freq)
+
+    if by:
+        id_index = col.index.droplevel('period')
+        series_codes, uniques = pd.factorize(id_index, sort=True)
+        if isinstance(uniques, pd.MultiIndex):
+            keys = uniques.to_frame(index=False, name=list(by))
+        else:
+            keys = pd.DataFrame({by[0]: uniques})
+        # keep the interned categorical dtypes of the id columns
+        for name in by:
+            keys[name] = keys[name].astype(id_index.get_level_values(name).dtype)
+    else:
+        series_codes = np.zeros(len(col), dtype=np.intp)
+        keys = pd.DataFrame(index=[0])
+
+    time_codes = period_level.asi8 - periods[0].ordinal
+    values = np.zeros((len(keys), len(periods)), dtype=np.float64)
+    values[series_codes, time_codes] = col.to_numpy()
+    return keys, periods, values
+
+
+def lag_window_features(values, lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS, min_periods=1):
+    """Lags and trailing rolling mean/std for every row of a (series × time) array.
+
+    Matches pandas ``shift(k)`` and ``rolling(w, min_periods).mean()/.std()``
+    along the time axis, computed with cumulative sums so the cost is one
+    pass per window regardless of the number of series. Returns a dict of
+    arrays keyed 'lag_k', 'roll_mean_w', 'roll_std_w'.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[None, :]
+    n_series, n_time = values.shape
+    out = {}
+
+    for k in lags:
+        lagged = np.full_like(values, np.nan)
+        if k < n_time:
+            lagged[:, k:] = values[:, :n_time - k]
+        out['lag_%d' % k] = lagged
+
+    # means come from the raw running sum (exact for integer counts, so an
+    # all-zero window is exactly 0); each series is centred before summing
+    # squares to keep the variance stable
+    centred = values - values.mean(axis=1, keepdims=True)
+    zeros = np.zeros((n_series, 1))
+    rawsum = np.concatenate([zeros, np.cumsum(values, axis=1)], axis=1)
+    csum = np.concatenate([zeros, np.cumsum(centred, axis=1)], axis=1)
+    csq = np.concatenate([zeros, np.cumsum(centred ** 2, axis=1)], axis=1)
+    end = np.arange(1, n_time + 1)
+
+    for w in windows:
+        start = np.maximum(end - w, 0)
+        count = (end - start).astype(np.float64)
+        wsum = csum[:, end] - csum[:, start]
+        wsq = csq[:, end] - csq[:, start]
+
+        centred_mean = wsum / count
+        # differences of running sums carry rounding error proportional to
+        # the running total; treat anything below it as an exact zero
+        spread = wsq - wsum * centred_mean
+        spread[spread < 64 * np.finfo(np.float64).eps * csq[:, end]] = 0.0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = spread / (count - 1)
+
+        mean = (rawsum[:, end] - rawsum[:, start]) / count
+        mean[:, count < min_periods] = np.nan
+        std = np.sqrt(var)
+        std[:, count < max(min_periods, 2)] = np.nan
+
+        out['roll_mean_%d' % w] = mean
+        out['roll_std_%d' % w] = std
+    return out
+
+
+def build_lag_features(cube, freq='M', by=('device_id', 'sku'),
+                       lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS, min_periods=1):
+    """Long-format feature matrix: one row per (series, period).
+
+    Columns are the ``by`` ids, 'period', the cube's value column and the
+    lag_k / roll_mean_w / roll_std_w features, all from one vectorized pass.
+    """
+    keys, periods, values = series_matrix(cube, freq, by)
+    features = lag_window_features(values, lags, windows, min_periods)
+
+    n_series, n_time = values.shape
+    frame = keys.loc[keys.index.repeat(n_time)].reset_index(drop=True)
+    frame['period'] = np.tile(periods, n_series)
+    frame[cube.value_col] = values.ravel()
+    for name, block in features.items():
+        frame[name] = block.ravel()
+    return frame
+
+
+def add_lag_features(df, col, lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS, min_periods=1):
+    """Add lag/rolling columns for a single time-ordered column of df, in place."""
+    for name, block in lag_window_features(df[col].to_numpy(), lags, windows, min_periods).items():
+        df[name] = block[0]
+    return df
+
+
+# ---------------------------------------------------------------------------
+# Dense zero-filled daily panel
+# ---------------------------------------------------------------------------
+
+class DailyPanel:
+    """(series × calendar day) block built from a daily table such as daily_inventory.
+
+    Attributes
+    ----------
+    keys : DataFrame
+        One row per series, with the ``by`` id columns (same keys as the daily table).
+    dates : DatetimeIndex
+        Contiguous daily calendar covering every series.
+    values : ndarray, float64, shape (len(keys), len(dates))
+        Daily totals, 0 on days without a dispense.
+    active : ndarray, bool, same shape
+        True inside the series' device active span (first to last day the
+        device dispensed anything; the series' own span when ``by`` has no
+        device_id); days outside it are not zero demand, they are unknown.
+    """
+
+    def __init__(self, keys, dates, values, active, value_col):
+        self.keys = keys
+        self.dates = dates
+        self.values = values
+        self.active = active
+        self.value_col = value_col
+
+    @classmethod
+    def from_daily(cls, daily, value_col='qty_dispensed', by=('device_id',), date_col='date'):
+        """Scatter a long daily table into the dense panel in one vectorized step."""
+        by = list(by)
+        dates = pd.date_range(daily[date_col].min(), daily[date_col].max(), freq='D')
+
+        series_codes, uniques = pd.factorize(pd.MultiIndex.from_frame(daily[by]), sort=True)
+        keys = uniques.to_frame(index=False, name=by)
+        for name in by:
+            keys[name] = keys[name].astype(daily[name].dtype)
+        day_codes = ((daily[date_col] - dates[0]) // pd.Timedelta(days=1)).to_numpy()
+
+        values = np.zeros((len(keys), len(dates)), dtype=np.float64)
+        np.add.at(values, (series_codes, day_codes), daily[value_col].to_numpy(dtype=np.float64))
+
+        # active span per device, broadcast to every series on that device; without a
+        # device column, per series
+        span_by = ['device_id'] if 'device_id' in by else by
+        span = daily.groupby(span_by, observed=True)[date_col].agg(['min', 'max'])
+        span.index = pd.MultiIndex.from_frame(span.index.to_frame(index=False))
+        series_span = span.reindex(pd.MultiIndex.from_frame(keys[span_by]))
+        first = ((series_span['min'] - dates[0]) // pd.Timedelta(days=1)).to_numpy()
+        last = ((series_span['max'] - dates[0]) // pd.Timedelta(days=1)).to_numpy()
+        day = np.arange(len(dates))
+        active = (day >= first[:, None]) & (day <= last[:, None])
+        return cls(keys, dates, values, active, value_col)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def masked(self):
+        """values as a masked array, masked outside each device's active span."""
+        return np.ma.MaskedArray(self.values, mask=~self.active)
+
+    def features(self, lags=(1, 7, 28), windows=(7, 28), min_periods=1):
+        """lag_window_features() over the panel, NaN outside the active span.
+
+        Because every calendar day is present, lag_k is always k days back.
+        """
+        out = lag_window_features(self.values, lags, windows, min_periods)
+        for block in out.values():
+            block[~self.active] = np.nan
+        return out
+
+    def to_frame(self, active_only=True, features=None):
+        """Long table with the daily table's keys plus one row per zero day.
+
+        features, if given, is a dict of panel-shaped arrays (e.g. from
+        ``features()``) added as extra columns.
+        """
+        n_series, n_days = self.values.shape
+        frame = self.keys.loc[self.keys.index.repeat(n_days)].reset_index(drop=True)
+        frame['date'] = np.tile(self.dates.to_numpy(), n_series)
+        frame[self.value_col] = self.values.ravel()
+        for name, block in (features or {}).items():
+            frame[name] = block.ravel()
+        if active_only:
+            frame = frame[self.active.ravel()].reset_index(drop=True)
+        return frame
+
+
+# ---------------------------------------------------------------------------
+# Calendar dimension table
+# ---------------------------------------------------------------------------
+
+CALENDAR_FIELDS = ['day_of_week', 'is_weekend', 'day_of_month', 'month', 'quarter', 'year']
+FOURIER_FIELDS = ['dow_sin', 'dow_cos', 'm_sin', 'm_cos']
+
+
+def date_keys(dates):
+    """Integer date key (days since 1970-01-01) for a datetime Series or index."""
+    days = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[D]')
+    return days.astype(np.int64).astype(np.int32)
+
+
+def _holiday_dates(holidays, start, end):
+    if holidays is None:
+        return pd.DatetimeIndex([])
+    if isinstance(holidays, str):
+        if holidays != 'us_federal':
+            raise ValueError('unknown holiday calendar: %r' % holidays)
+        from pandas.tseries.holiday import USFederalHolidayCalendar
+        return USFederalHolidayCalendar().holidays(start, end)
+    return pd.DatetimeIndex(pd.to_datetime(list(holidays))).normalize()
+
+
+def calendar_table(start, end, weekly_order=1, monthly_order=1, holidays='us_federal'):
+    """One row per calendar day from start to end with every calendar feature.
+
+    Columns: date, date_key, the CALENDAR_FIELDS, is_holiday, and Fourier
+    terms for the weekly (period 7) and yearly-by-month (period 12) cycles.
+    Harmonic 1 keeps the script's names (dow_sin, dow_cos, m_sin, m_cos);
+    harmonic k > 1 is suffixed, e.g. dow_sin_2. holidays is 'us_federal',
+    an iterable of dates, or None.
+    """
+    dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize(), freq='D')
+    dow = dates.dayofweek.to_numpy()
+    month = dates.month.to_numpy()
+
+    cal = pd.DataFrame({
+        'date':         dates,
+        'date_key':     date_keys(dates),
+        'day_of_week':  dow.astype(np.int8),          # 0=Mon … 6=Sun
+        'is_weekend':   (dow >= 5).astype(np.int8),
+        'day_of_month': dates.day.to_numpy().astype(np.int8),
+        'month':        month.astype(np.int8),
+        'quarter':      dates.quarter.to_numpy().astype(np.int8),
+        'year':         dates.year.to_numpy().astype(np.int16),
+        'is_holiday':   dates.isin(_holiday_dates(holidays, dates[0], dates[-1])).astype(np.int8),
+    })
+
+    for k in range(1, weekly_order + 1):
+        suffix = '' if k == 1 else '_%d' % k
+        cal['dow_sin' + suffix] = np.sin(2 * np.pi * k * dow / 7)
+        cal['dow_cos' + suffix] = np.cos(2 * np.pi * k * dow / 7)
+    for k in range(1, monthly_order + 1):
+        suffix = '' if k == 1 else '_%d' % k
+        cal['m_sin' + suffix] = np.sin(2 * np.pi * k * (month - 1) / 12)
+        cal['m_cos' + suffix] = np.cos(2 * np.pi * k * (month - 1) / 12)
+    return cal
+
+
+def add_calendar_features(df, calendar, columns=None, date_col='date'):
+    """Join calendar columns onto df by integer date key, in place.
+
+    The calendar is contiguous, so the join is a positional take
+    (key - first key) rather than a hash merge. Existing columns with the
+    same names are overwritten.
+    """
+    if columns is None:
+        columns = [c for c in calendar.columns if c not in ('date', 'date_key')]
+    pos = date_keys(df[date_col]).astype(np.int64) - int(calendar['date_key'].iloc[0])
+    if len(pos) and (pos.min() < 0 or pos.max() >= len(calendar)):
+        raise ValueError('dates in %r fall outside the calendar table' % date_col)
+    for col in columns:
+        df[col] = calendar[col].to_numpy()[pos]
+    return df
@@ -0,0 +1,1209 @@
+# -*- coding: utf-8 -*-
+"""Per-series demand forecasting for the (device, SKU) monthly series.
+
+The series come from ``vending_features.series_matrix`` as one dense
+(series × month) array. Each series gets its own SARIMAX fit; fits are
+grouped into batches and fanned out over a process pool, and every
+forecast comes back in a single long frame together with its fit
+diagnostics. A model registry keeps each fit's parameters and final state
+so that next month's refit can filter forward or warm-start instead of
+running a full MLE, and orders can be chosen per series by a pruned
+AIC/BIC search seeded from each series' ACF/PACF.
+
+GlobalDemandModel is the alternative to per-series fits: one
+gradient-boosted model trained on every (device, SKU) daily series
+stacked together, scored for all series in one batch call. Sporadic
+long-tail series are routed to Croston / SBA / TSB instead, which run as
+one recurrence over the whole (series × time) array. SegmentIndex holds
+the ABC (volume) / XYZ (variability) class of every SKU and (device, SKU)
+series and maps each segment to a model and refit cadence.
+
+Every forecaster is also registered by name in FORECASTERS, so that
+backtest() can compare them by rolling-origin cross-validation, running
+the folds in parallel. Hierarchy sums the (device, SKU) series into device,
+SKU and fleet totals through a sparse summing matrix and reconciles
+forecasts made at every level so that they add up.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from vending_features import DailyPanel, date_keys, lag_window_features, series_matrix
+
+# AR(1) plus a 12-month seasonal AR term, per the ACF/PACF section
+DEFAULT_ORDER = (1, 0, 0)
+DEFAULT_SEASONAL_ORDER = (1, 0, 0, 12)
+
+
+def _pool_context():
+    # forked workers don't re-import the calling script; spawn/forkserver
+    # would re-run every top-level cell of vending_analysis.py per worker
+    if sys.platform.startswith('linux') and 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def run_batched(func, tasks, n_jobs=None, batch_size=8):
+    """Apply a module-level func to every task, in batches across worker processes.
+
+    n_jobs=1 runs in-process. Results come back in task order.
+    """
+    tasks = list(tasks)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(tasks) <= batch_size:
+        return [func(task) for task in tasks]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=_pool_context()) as pool:
+        for batch_result in pool.map(_run_batch, [(func, batch) for batch in _batches(tasks, batch_size)]):
+            results.extend(batch_result)
+    return results
+
+
+def _run_batch(job):
+    func, batch = job
+    return [func(task) for task in batch]
+
+
+def fit_sarimax(values, order=DEFAULT_ORDER, seasonal_order=DEFAULT_SEASONAL_ORDER,
+                trend='c', start_params=None, maxiter=200):
+    """Fit one SARIMAX to a 1-D array; returns the statsmodels results object."""
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    model = SARIMAX(values, order=order, seasonal_order=seasonal_order, trend=trend,
+                    enforce_stationarity=False, enforce_invertibility=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return model.fit(start_params=start_params, disp=False, maxiter=maxiter)
+
+
+def _min_obs(order, seasonal_order):
+    p, d, q = order
+    P, D, Q, s = seasonal_order
+    return max(p + d + q, (P + D + Q) * s + d) + 3
+
+
+def _forecast_task(task):
+    """Worker: fit one series and forecast it. task is a dict (picklable).
+
+    With a registry entry in the task the fit is, cheapest first:
+    'cached' (same data: filter with the stored params), 'append' (only new
+    months: filter them forward from the stored end state), 'warm' (MLE
+    started from the stored params) or 'full'.
+    """
+    values = task['values']
+    horizon = task['horizon']
+    order, seasonal_order = task['order'], task['seasonal_order']
+    out = {
+        'forecast':  np.full(horizon, np.nan),
+        'lower':     np.full(horizon, np.nan),
+        'upper':     np.full(horizon, np.nan),
+        'aic':       np.nan,
+        'bic':       np.nan,
+        'llf':       np.nan,
+        'converged': False,
+        'status':    'ok',
+        'fit_mode':  None,
+        'fit_seconds': 0.0,
+        'entry':     None,
+    }
+
+    if np.all(values == values[0]):
+        # SARIMAX cannot estimate a constant series; forecast the constant
+        out['forecast'][:] = out['lower'][:] = out['upper'][:] = values[0]
+        out['status'] = 'constant'
+        return out
+    if len(values) < _min_obs(order, seasonal_order):
+        out['status'] = 'too_short'
+        return out
+
+    start = time.perf_counter()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            res, fit_mode = _fit_from_entry(values, order, seasonal_order,
+                                            task['trend'], task.get('entry'),
+                                            task.get('refit', 'filter'))
+            fc = res.get_forecast(horizon)
+            ci = np.asarray(fc.conf_int(alpha=task['alpha']))
+            aic, bic, llf = res.aic, res.bic, res.llf
+            stationary = _is_stationary(res)
+        if fit_mode in ('cached', 'append'):
+            # filter-only fits reuse stored parameters: report whether their MLE converged
+            converged = task['entry'].get('converged', False)
+        else:
+            converged = res.mle_retvals.get('converged', False)
+        if fit_mode == 'append':
+            # the likelihood covers only the newly filtered months, not comparable to a full fit
+            aic = bic = llf = np.nan
+        if not stationary or not np.all(np.isfinite(fc.predicted_mean)):
+            # an explosive AR part forecasts off to infinity; keep NaN and do not store it
+            out.update(converged=bool(converged), fit_mode=fit_mode, status='nonstationary',
+                       fit_seconds=time.perf_counter() - start)
+            return out
+        out.update(
+            forecast=np.asarray(fc.predicted_mean),
+            lower=ci[:, 0],
+            upper=ci[:, 1],
+            aic=aic,
+            bic=bic,
+            llf=llf,
+            converged=bool(converged),
+            fit_mode=fit_mode,
+            entry=_registry_entry(res, values, order, seasonal_order, task['trend'], converged),
+        )
+    except Exception as exc:  # one bad series must not sink the batch
+        out['status'] = 'error: %s' % type(exc).__name__
+    out['fit_seconds'] = time.perf_counter() - start
+    return out
+
+
+def _forecast_frame(keys, periods, horizon, results, columns=('forecast', 'lower', 'upper')):
+    n_series = len(keys)
+    future = pd.period_range(periods[-1] + 1, periods=horizon, freq=periods.freq)
+
+    frame = keys.loc[keys.index.repeat(horizon)].reset_index(drop=True)
+    frame['period'] = np.tile(future, n_series)
+    frame['step'] = np.tile(np.arange(1, horizon + 1), n_series)
+    for col in columns:
+        frame[col] = np.concatenate([r[col] for r in results]) if n_series else []
+    for col in ('aic', 'bic', 'llf', 'converged', 'status', 'fit_mode', 'fit_seconds'):
+        frame[col] = np.repeat([r[col] for r in results], horizon)
+    return frame
+
+
+def forecast_series(keys, periods, values, horizon=6, order=DEFAULT_ORDER,
+                    seasonal_order=DEFAULT_SEASONAL_ORDER, trend='c', alpha=0.05,
+                    n_jobs=None, batch_size=8, registry=None, refit='filter'):
+    """SARIMAX forecasts for every row of a (series × period) array.
+
+    order / seasonal_order are either shared by all series or given per
+    series. Parameters mirror ``series_matrix``'s output: keys (one row per series),
+    periods (PeriodIndex) and values. Returns one long frame with a row per
+    (series, forecast step): the key columns, period, step, forecast and its
+    (1 - alpha) interval, plus the series' aic/bic/llf, convergence flag,
+    status ('ok', 'constant', 'too_short', 'nonstationary' or 'error: ...'),
+    fit mode and fit time. 'cached' and 'append' fits report the
+    convergence of the fit whose parameters they reuse; 'append' fits have
+    NaN aic/bic/llf, as their likelihood covers only the new months. Fits
+    whose AR part is explosive get status
+    'nonstationary' and NaN forecasts rather than forecasts that diverge.
+
+    With a ModelRegistry, stored fits are reused (see _forecast_task) and
+    every new fit is written back. refit='filter' lets a series whose
+    history is unchanged and only gained months be filtered forward from
+    its stored state; refit='warm' always re-estimates, starting from the
+    stored parameters.
+    """
+    records = keys.to_dict('records')
+    orders = _per_series(order, len(records))
+    seasonal_orders = _per_series(seasonal_order, len(records))
+    tasks = [
+        {
+            'values':         np.asarray(row, dtype=np.float64),
+            'horizon':        horizon,
+            'order':          o,
+            'seasonal_order': so,
+            'trend':          trend,
+            'alpha':          alpha,
+            'refit':          refit,
+            'entry':          registry.get(ids, o, so, trend) if registry else None,
+        }
+        for ids, row, o, so in zip(records, values, orders, seasonal_orders)
+    ]
+    results = run_batched(_forecast_task, tasks, n_jobs=n_jobs, batch_size=batch_size)
+    if registry is not None:
+        for ids, result, o, so in zip(records, results, orders, seasonal_orders):
+            if result['entry'] is not None:
+                registry.put(ids, o, so, trend, result['entry'])
+    frame = _forecast_frame(keys, periods, horizon, results)
+    frame['order'] = np.repeat(np.array(orders + [None], dtype=object)[:-1], horizon)
+    frame['seasonal_order'] = np.repeat(np.array(seasonal_orders + [None], dtype=object)[:-1], horizon)
+    return frame
+
+
+def _per_series(order, n_series):
+    """One order shared by every series, or a sequence of per-series orders
+    (e.g. the order / seasonal_order columns of select_orders())."""
+    if len(order) and np.ndim(order[0]) == 0:
+        return [tuple(int(x) for x in order)] * n_series
+    if len(order) != n_series:
+        raise ValueError('expected %d per-series orders, got %d' % (n_series, len(order)))
+    return [tuple(int(x) for x in o) for o in order]
+
+
+def forecast_pivot(pivot, **kwargs):
+    """forecast_series() on a wide (month × series) table such as monthly_by_sku_all."""
+    columns = pivot.columns
+    if isinstance(columns, pd.MultiIndex):
+        keys = columns.to_frame(index=False)
+    else:
+        keys = pd.DataFrame({columns.name or 'series': np.asarray(columns)})
+    periods = pd.PeriodIndex(pivot.index, freq='M')
+    return forecast_series(keys, periods, pivot.to_numpy(dtype=np.float64).T, **kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Model registry: warm starts and filter-forward refits
+# ---------------------------------------------------------------------------
+
+def data_hash(values):
+    """SHA-1 of a series' float64 observations."""
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=np.float64).tobytes()).hexdigest()
+
+
+def _registry_entry(res, values, order, seasonal_order, trend, converged):
+    return {
+        'order':          list(order),
+        'seasonal_order': list(seasonal_order),
+        'trend':          trend,
+        'param_names':    list(res.model.param_names),
+        'params':         np.asarray(res.params).tolist(),
+        'converged':      bool(converged),
+        'n_obs':          len(values),
+        'data_hash':      data_hash(values),
+        # one-step-ahead state after the last observation, to filter forward from
+        'state':          res.predicted_state[:, -1].tolist(),
+        'state_cov':      res.predicted_state_cov[:, :, -1].tolist(),
+    }
+
+
+def _fit_from_entry(values, order, seasonal_order, trend, entry, refit):
+    """Reuse a registry entry where possible; returns (results, fit_mode)."""
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    if entry is None:
+        return fit_sarimax(values, order, seasonal_order, trend), 'full'
+
+    params = np.asarray(entry['params'])
+    n_old = entry['n_obs']
+
+    if len(values) == n_old and data_hash(values) == entry['data_hash']:
+        model = SARIMAX(values, order=order, seasonal_order=seasonal_order, trend=trend,
+                        enforce_stationarity=False, enforce_invertibility=False)
+        return model.filter(params), 'cached'
+
+    history_unchanged = len(values) > n_old and data_hash(values[:n_old]) == entry['data_hash']
+    if refit == 'filter' and history_unchanged and trend in ('n', 'c', None):
+        # time-invariant model: filter only the new months from the stored state;
+        # forecasts match a full re-filter, the likelihood covers the new months only
+        model = SARIMAX(values[n_old:], order=order, seasonal_order=seasonal_order, trend=trend,
+                        enforce_stationarity=False, enforce_invertibility=False)
+        model.ssm.initialize_known(np.asarray(entry['state']), np.asarray(entry['state_cov']))
+        return model.filter(params), 'append'
+
+    return fit_sarimax(values, order, seasonal_order, trend, start_params=params), 'warm'
+
+
+class ModelRegistry:
+    """Fitted SARIMAX parameters and end states on disk, one JSON file per model.
+
+    A model is identified by its series ids (e.g. sku and device_id), order,
+    seasonal_order and trend; each entry records the data hash and length of
+    the series it was fitted on, which decides how it can be reused.
+    """
+
+    def __init__(self, root='.vending_models'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, ids, order, seasonal_order, trend):
+        ident = json.dumps({
+            'ids':            {k: str(v) for k, v in sorted(ids.items())},
+            'order':          list(order),
+            'seasonal_order': list(seasonal_order),
+            'trend':          trend,
+        }, sort_keys=True)
+        return os.path.join(self.root, hashlib.sha1(ident.encode()).hexdigest() + '.json')
+
+    def get(self, ids, order, seasonal_order, trend='c'):
+        path = self._path(ids, order, seasonal_order, trend)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fh:
+            return json.load(fh)
+
+    def put(self, ids, order, seasonal_order, trend, entry):
+        path = self._path(ids, order, seasonal_order, trend)
+        entry = dict(entry, ids={k: str(v) for k, v in ids.items()})
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(entry, fh)
+        os.replace(tmp, path)
+
+
+# ---------------------------------------------------------------------------
+# Automatic order selection
+# ---------------------------------------------------------------------------
+
+def _last_significant(values, max_lag, bound):
+    """Highest lag in 1..max_lag whose |value| clears the white-noise bound."""
+    lags = [k for k in range(1, min(max_lag, len(values) - 1) + 1) if abs(values[k]) > bound]
+    return lags[-1] if lags else 0
+
+
+def _seed_order(values, acf_values, pacf_values, d, D, s, max_p, max_q, max_P, max_Q):
+    """Starting (p,d,q)(P,D,Q,s) from the ACF/PACF, as the ACF/PACF section reads them by eye."""
+    bound = 1.96 / np.sqrt(len(values))
+    p = _last_significant(pacf_values, max_p, bound)
+    q = _last_significant(acf_values, max_q, bound)
+    seasonal_spike = len(acf_values) > s and abs(acf_values[s]) > bound
+    P = min(max_P, 1) if seasonal_spike else 0
+    Q = 0 if P or max_Q == 0 else (1 if seasonal_spike else 0)
+    return (p, d, q), (P, D, Q, s)
+
+
+def _is_stationary(res):
+    roots = np.asarray(getattr(res, 'arroots', []))
+    return roots.size == 0 or bool(np.all(np.abs(roots) > 1.0))
+
+
+def _select_task(task):
+    """Worker: stepwise search for one series.
+
+    The differencing orders are fixed first — D from the seasonal strength
+    passed in the task, d by ADF on the (seasonally differenced) series —
+    because likelihoods of differently differenced data cannot be compared.
+    The search then starts at the ACF/PACF seed and moves to the
+    best-scoring neighbour (p, q, P, Q each ±1) until nothing improves. Candidates that do not
+    leave enough observations are never fitted, fits with a non-stationary
+    AR part are discarded, and the search stops after max_failures
+    convergence failures.
+    """
+    from statsmodels.tsa.stattools import acf, pacf, adfuller
+
+    values = task['values']
+    s, criterion = task['s'], task['criterion']
+    out = {'order': None, 'seasonal_order': None, 'score': np.nan, 'aic': np.nan,
+           'bic': np.nan, 'seed_order': None, 'seed_seasonal_order': None,
+           'fitted': 0, 'failures': 0, 'pruned': 0, 'status': 'ok'}
+    if np.all(values == values[0]):
+        out['status'] = 'constant'
+        return out
+
+    # the seasonal seed reads the lag-s ACF, so the ACF always reaches s + 1 lags; the
+    # PACF estimate is only defined up to half the sample and seeds p alone
+    acf_values = task['acf']
+    if acf_values is None or len(acf_values) <= s:
+        acf_values = acf(values, nlags=min(s + 1, len(values) - 1), fft=True)
+    pacf_values = task['pacf'] if task['pacf'] is not None else pacf(
+        values, nlags=min(s + 1, len(values) // 2 - 1))
+
+    # one differencing decision per series instead of searching over d and D
+    D = task['D']
+    differenced = values[s:] - values[:-s] if D else values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            d = 0 if adfuller(differenced, autolag='AIC')[1] < 0.05 else 1
+        except (ValueError, np.linalg.LinAlgError):
+            d = 0
+    d = min(d, task['max_d'])
+
+    seed = _seed_order(values, acf_values, pacf_values, d, D, s,
+                       task['max_p'], task['max_q'], task['max_P'], task['max_Q'])
+    out['seed_order'], out['seed_seasonal_order'] = seed
+
+    limits = {'p': task['max_p'], 'q': task['max_q'], 'P': task['max_P'], 'Q': task['max_Q']}
+    scores = {}
+
+    def evaluate(cand):
+        if cand in scores:
+            return scores[cand]
+        order, seasonal_order = cand
+        scores[cand] = None
+        if len(values) - order[1] - seasonal_order[1] * s < _min_obs(order, seasonal_order):
+            out['pruned'] += 1
+            return None
+        out['fitted'] += 1
+        try:
+            res = fit_sarimax(values, order, seasonal_order, task['trend'])
+        except Exception:
+            out['failures'] += 1
+            return None
+        if not res.mle_retvals.get('converged', False):
+            out['failures'] += 1
+            return None
+        if not _is_stationary(res):
+            out['pruned'] += 1
+            return None
+        scores[cand] = (getattr(res, criterion), res.aic, res.bic)
+        return scores[cand]
+
+    def neighbours(cand):
+        (p, d_, q), (P, D, Q, _) = cand
+        current = {'p': p, 'q': q, 'P': P, 'Q': Q}
+        for name, value in current.items():
+            for step in (-1, 1):
+                new = dict(current, **{name: value + step})
+                if 0 <= new[name] <= limits[name]:
+                    yield ((new['p'], d_, new['q']), (new['P'], D, new['Q'], s))
+
+    best = seed
+    best_score = evaluate(seed)
+    improved = True
+    while improved and out['failures'] < task['max_failures']:
+        improved = False
+        for cand in neighbours(best):
+            if out['failures'] >= task['max_failures']:
+                break
+            score = evaluate(cand)
+            if score is not None and (best_score is None or score[0] < best_score[0]):
+                best, best_score, improved = cand, score, True
+
+    if best_score is None:
+        out['status'] = 'no_valid_fit'
+        return out
+    out['order'], out['seasonal_order'] = best
+    out['score'], out['aic'], out['bic'] = best_score
+    return out
+
+
+def select_orders(keys, periods, values, criterion='aic', s=12, max_p=2, max_q=2,
+                  max_P=1, max_Q=1, max_d=1, max_D=1, max_failures=3, trend='c',
+                  acf_values=None, pacf_values=None, seasonal_threshold=0.64,
+                  n_jobs=None, batch_size=4):
+    """Choose a (p,d,q)(P,D,Q,s) per series by AIC or BIC, across worker processes.
+
+    Each series starts from an ACF/PACF seed (pass acf_values / pacf_values,
+    arrays of shape (series, lags + 1), to reuse ones already computed; an
+    ACF block shorter than s + 1 lags is recomputed per series) and
+    runs a pruned stepwise search; see _select_task. Seasonal differencing
+    is decided before the search: D = 1 (if max_D allows) when the series'
+    seasonal strength exceeds seasonal_threshold, the 0.64 of the nsdiffs
+    rule, and at least two full cycles remain after differencing (three
+    cycles of history); otherwise D = 0. Returns one row per
+    series: the keys, the chosen order and seasonal_order (None when no
+    candidate fitted), its score/aic/bic, the seed, the seasonal strength
+    and how many candidates were fitted, failed to converge or were pruned.
+    """
+    # imported here: vending_diagnostics itself imports this module
+    from vending_diagnostics import seasonal_strength
+
+    if criterion not in ('aic', 'bic'):
+        raise ValueError("criterion must be 'aic' or 'bic'")
+    values = np.asarray(values, dtype=np.float64)
+    strength = seasonal_strength(values, s)
+    # NaN below three cycles, which also leaves two full cycles after differencing
+    seasonal_d = np.where(np.nan_to_num(strength) > seasonal_threshold, min(max_D, 1), 0)
+    tasks = [
+        {
+            'values':       np.asarray(row, dtype=np.float64),
+            'acf':          None if acf_values is None else np.asarray(acf_values[i]),
+            'pacf':         None if pacf_values is None else np.asarray(pacf_values[i]),
+            'criterion':    criterion,
+            's':            s,
+            'max_p':        max_p,
+            'max_q':        max_q,
+            'max_P':        max_P,
+            'max_Q':        max_Q,
+            'max_d':        max_d,
+            'D':            int(seasonal_d[i]),
+            'max_failures': max_failures,
+            'trend':        trend,
+        }
+        for i, row in enumerate(values)
+    ]
+    results = run_batched(_select_task, tasks, n_jobs=n_jobs, batch_size=batch_size)
+    frame = keys.reset_index(drop=True).copy()
+    for col in ('order', 'seasonal_order', 'seed_order', 'seed_seasonal_order'):
+        frame[col] = pd.Series([r[col] for r in results], dtype=object)
+    frame['seasonal_strength'] = strength
+    for col in ('score', 'aic', 'bic', 'fitted', 'failures', 'pruned', 'status'):
+        frame[col] = [r[col] for r in results]
+    return frame
+
+
+# ---------------------------------------------------------------------------
+# Global gradient-boosted model over all daily series
+# ---------------------------------------------------------------------------
+
+GLOBAL_LAGS = (1, 7, 28)
+GLOBAL_WINDOWS = (7, 28)
+GLOBAL_CALENDAR_FIELDS = ['day_of_week', 'is_weekend', 'day_of_month', 'month', 'is_holiday',
+                          'dow_sin', 'dow_cos', 'm_sin', 'm_cos']
+
+
+def _id_codes(keys, id_columns):
+    codes = {}
+    for name in id_columns:
+        col = keys[name]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            codes[name] = col.cat.codes.to_numpy()
+        else:
+            codes[name] = pd.factorize(col, sort=True)[0]
+    return codes
+
+
+class GlobalDemandModel:
+    """One HistGradientBoostingRegressor for every series of a DailyPanel.
+
+    Each (series, day) cell is a training row. Features are the series'
+    lags and trailing rolling mean/std as of the previous day, the calendar
+    table's columns for the day, and the interned device_id / sku codes
+    (treated as categorical while they fit in the model's bins). The
+    default Poisson loss suits daily unit counts. Extra keyword arguments
+    go to the regressor.
+    """
+
+    def __init__(self, lags=GLOBAL_LAGS, windows=GLOBAL_WINDOWS,
+                 calendar_columns=GLOBAL_CALENDAR_FIELDS, id_columns=('device_id', 'sku'),
+                 **params):
+        self.lags = tuple(lags)
+        self.windows = tuple(windows)
+        self.calendar_columns = list(calendar_columns)
+        self.id_columns = list(id_columns)
+        self.params = dict({'loss': 'poisson', 'max_iter': 300, 'learning_rate': 0.05,
+                            'random_state': 0}, **params)
+        self.model = None
+        self.feature_names = None
+
+    @property
+    def _span(self):
+        # history needed for every feature of one day
+        return max(self.lags + self.windows)
+
+    def _blocks(self, values, keys, dates, calendar):
+        """Feature name -> array broadcastable to values.shape."""
+        n_series, n_days = values.shape
+        blocks = {}
+        for name, block in lag_window_features(values, self.lags, self.windows).items():
+            if name.startswith('roll_'):
+                # rolling stats include the current day; shift so day t sees up to t-1
+                block = np.concatenate([np.full((n_series, 1), np.nan), block[:, :-1]], axis=1)
+            blocks[name] = block
+        pos = date_keys(dates).astype(np.int64) - int(calendar['date_key'].iloc[0])
+        if pos.min() < 0 or pos.max() >= len(calendar):
+            raise ValueError('panel dates fall outside the calendar table')
+        for col in self.calendar_columns:
+            blocks[col] = calendar[col].to_numpy()[pos][None, :]
+        for name, codes in _id_codes(keys, self.id_columns).items():
+            blocks[name] = codes[:, None]
+        return blocks
+
+    def design_matrix(self, values, keys, dates, calendar):
+        """Stacked float32 feature matrix, one row per (series, day) in row-major order."""
+        blocks = self._blocks(values, keys, dates, calendar)
+        X = np.empty((values.size, len(blocks)), dtype=np.float32)
+        for j, block in enumerate(blocks.values()):
+            X[:, j] = np.broadcast_to(block, values.shape).ravel()
+        self.feature_names = list(blocks)
+        return X
+
+    def _trainable(self, panel, until):
+        # active days whose whole lag/window history is inside the active span
+        span = self._span
+        rows = panel.active.copy()
+        rows[:, :span] = False
+        rows[:, span:] &= panel.active[:, :-span]
+        if until is not None:
+            rows &= np.asarray(panel.dates <= pd.Timestamp(until))[None, :]
+        return rows
+
+    def fit(self, panel, calendar, until=None):
+        """Train on every usable cell of the panel (up to and including until)."""
+        from sklearn.ensemble import HistGradientBoostingRegressor
+
+        X = self.design_matrix(panel.values, panel.keys, panel.dates, calendar)
+        rows = self._trainable(panel, until).ravel()
+        max_bins = self.params.get('max_bins', 255)
+        categorical = [name in self.id_columns and X[:, j].max() < max_bins
+                       for j, name in enumerate(self.feature_names)]
+        self.model = HistGradientBoostingRegressor(categorical_features=categorical, **self.params)
+        self.model.fit(X[rows], panel.values.ravel()[rows])
+        return self
+
+    def predict(self, panel, calendar):
+        """One-step-ahead prediction for every cell, as a panel-shaped array.
+
+        All series are scored in a single predict() call; cells outside a
+        series' active span are NaN.
+        """
+        X = self.design_matrix(panel.values, panel.keys, panel.dates, calendar)
+        pred = self.model.predict(X).reshape(panel.shape)
+        pred[~panel.active] = np.nan
+        return pred
+
+    def forecast(self, panel, calendar, horizon=28):
+        """Recursive daily forecast after the panel's last day for every series.
+
+        Each step builds features for the next day of all series from the
+        trailing history (observed, then predicted) and scores them in one
+        batch call. Returns a long frame: the key columns, date, step and
+        forecast.
+        """
+        n_series, n_days = panel.shape
+        span = self._span
+        history = np.concatenate([panel.values[:, -span:], np.zeros((n_series, horizon))], axis=1)
+        future = pd.date_range(panel.dates[-1] + pd.Timedelta(days=1), periods=horizon, freq='D')
+        dates = panel.dates[-span:].append(future)
+
+        out = np.empty((n_series, horizon))
+        for step in range(horizon):
+            t = span + step
+            window = history[:, t - span:t + 1]
+            X = self.design_matrix(window, panel.keys, dates[t - span:t + 1], calendar)
+            pred = self.model.predict(X[span::span + 1])
+            history[:, t] = out[:, step] = np.maximum(pred, 0.0)
+
+        frame = panel.keys.loc[panel.keys.index.repeat(horizon)].reset_index(drop=True)
+        frame['date'] = np.tile(future.to_numpy(), n_series)
+        frame['step'] = np.tile(np.arange(1, horizon + 1), n_series)
+        frame['forecast'] = out.ravel()
+        return frame
+
+
+# ---------------------------------------------------------------------------
+# Intermittent demand: Croston / SBA / TSB and routing
+# ---------------------------------------------------------------------------
+
+# Syntetos-Boylan cut-offs on the average inter-demand interval and the
+# squared CV of the non-zero demand sizes
+ADI_CUTOFF = 1.32
+CV2_CUTOFF = 0.49
+INTERMITTENT_METHODS = ('croston', 'sba', 'tsb')
+
+
+def classify_demand(keys, values, adi_cutoff=ADI_CUTOFF, cv2_cutoff=CV2_CUTOFF):
+    """Demand class and forecasting method per series of a (series × time) array.
+
+    Columns added to keys: n_nonzero, adi (periods per demand), cv2 (of the
+    non-zero sizes), cv (std / mean of the whole series, as in
+    sku_variability), demand_class ('smooth', 'erratic', 'intermittent',
+    'lumpy' or 'no_demand') and method: smooth and erratic series stay on
+    'sarima', intermittent ones go to 'croston', lumpy ones to 'sba', and
+    any intermittent/lumpy series that has gone quiet for longer than twice
+    its ADI goes to 'tsb', whose forecast decays while no demand arrives.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_time = values.shape[1]
+    nonzero = values > 0
+    n_nonzero = nonzero.sum(axis=1)
+
+    # rows with fewer than two demands give empty-slice warnings; their NaNs are handled below
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        adi = n_time / n_nonzero
+        sizes = np.where(nonzero, values, np.nan)
+        size_mean = np.nanmean(sizes, axis=1)
+        size_var = np.where(n_nonzero > 1, np.nanvar(sizes, axis=1, ddof=1), 0.0)
+        cv2 = size_var / size_mean ** 2
+        cv = values.std(axis=1, ddof=1) / values.mean(axis=1)
+
+    # periods since the last demand (n_time when there never was one)
+    last = np.where(nonzero.any(axis=1), n_time - 1 - np.argmax(nonzero[:, ::-1], axis=1), -1)
+    quiet = n_time - 1 - last
+
+    sporadic = adi > adi_cutoff
+    erratic = cv2 > cv2_cutoff
+    demand_class = np.select(
+        [n_nonzero == 0, sporadic & erratic, sporadic, erratic],
+        ['no_demand', 'lumpy', 'intermittent', 'erratic'], default='smooth')
+    method = np.select(
+        [n_nonzero == 0, sporadic & (quiet > 2 * adi), sporadic & erratic, sporadic],
+        ['tsb', 'tsb', 'sba', 'croston'], default='sarima')
+
+    frame = keys.reset_index(drop=True).copy()
+    frame['n_nonzero'] = n_nonzero
+    frame['adi'] = adi
+    frame['cv2'] = cv2
+    frame['cv'] = cv
+    frame['demand_class'] = demand_class
+    frame['method'] = method
+    return frame
+
+
+def intermittent_forecast(values, method='sba', alpha=0.1, beta=0.1):
+    """Croston, SBA or TSB for every row of a (series × time) array.
+
+    The recurrence steps through time once, updating all series together.
+    Returns (forecast, fitted): the flat per-period forecast after the last
+    period, shape (series,), and the one-step-ahead in-sample forecasts,
+    shape (series, time), NaN before a series' first demand (0 for TSB on
+    series that never had one).
+    """
+    if method not in INTERMITTENT_METHODS:
+        raise ValueError('method must be one of %s' % (INTERMITTENT_METHODS,))
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[None, :]
+    n_series, n_time = values.shape
+
+    size = np.full(n_series, np.nan)      # smoothed demand size
+    interval = np.full(n_series, np.nan)  # smoothed inter-demand interval (Croston/SBA)
+    prob = np.full(n_series, np.nan)      # smoothed demand probability (TSB)
+    since = np.ones(n_series)             # periods since the previous demand
+    fitted = np.empty((n_series, n_time))
+
+    for t in range(n_time):
+        if method == 'tsb':
+            fitted[:, t] = prob * size
+        else:
+            fitted[:, t] = size / interval
+        demand = values[:, t]
+        hit = demand > 0
+        new = hit & np.isnan(size)
+        seen = hit & ~new
+
+        size[new] = demand[new]
+        size[seen] += alpha * (demand[seen] - size[seen])
+        if method == 'tsb':
+            # every period moves the probability, demand or not
+            prob[new] = 1.0 / since[new]
+            started = ~np.isnan(prob) & ~new
+            prob[started] += beta * (hit[started] - prob[started])
+        else:
+            interval[new] = since[new]
+            interval[seen] += alpha * (since[seen] - interval[seen])
+        since = np.where(hit, 1.0, since + 1.0)
+
+    if method == 'tsb':
+        forecast = prob * size
+        never = np.isnan(size)
+        forecast[never] = 0.0
+        fitted[never] = 0.0
+    else:
+        forecast = size / interval
+        if method == 'sba':
+            forecast = forecast * (1 - alpha / 2)
+            fitted = fitted * (1 - alpha / 2)
+    return forecast, fitted
+
+
+def forecast_intermittent(keys, periods, values, horizon=6, method='sba', alpha=0.1, beta=0.1):
+    """intermittent_forecast() in forecast_series()'s long format.
+
+    method is one name for every series or a per-series sequence (e.g. the
+    method column of classify_demand()); each method runs once over its
+    group of rows. The forecast is flat over the horizon.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_series = len(values)
+    methods = np.asarray([method] * n_series if isinstance(method, str) else list(method), dtype=object)
+
+    level = np.full(n_series, np.nan)
+    for name in INTERMITTENT_METHODS:
+        rows = methods == name
+        if rows.any():
+            level[rows] = intermittent_forecast(values[rows], name, alpha, beta)[0]
+
+    future = pd.period_range(periods[-1] + 1, periods=horizon, freq=periods.freq)
+    frame = keys.reset_index(drop=True)
+    frame = frame.loc[frame.index.repeat(horizon)].reset_index(drop=True)
+    frame['period'] = np.tile(future, n_series)
+    frame['step'] = np.tile(np.arange(1, horizon + 1), n_series)
+    frame['forecast'] = np.repeat(level, horizon)
+    frame['method'] = np.repeat(methods, horizon)
+    return frame
+
+
+# ---------------------------------------------------------------------------
+# ABC / XYZ segmentation and model routing
+# ---------------------------------------------------------------------------
+
+ABC_CUTOFFS = (0.80, 0.95)   # cumulative volume share closing classes A and B
+XYZ_CUTOFFS = (0.5, 1.0)     # monthly CV closing classes X and Y
+
+# segment -> (model, refit mode, months between refits): heavy models and
+# frequent refits where volume is high and demand is predictable
+SEGMENT_POLICY = {
+    'AX': ('sarima_selected', 'warm', 1),
+    'AY': ('sarima_selected', 'warm', 1),
+    'AZ': ('sarima', 'filter', 1),
+    'BX': ('sarima', 'filter', 1),
+    'BY': ('sarima', 'filter', 3),
+    'BZ': ('global', 'filter', 3),
+    'CX': ('global', 'filter', 3),
+    'CY': ('global', 'filter', 6),
+    'CZ': ('intermittent', 'filter', 6),
+}
+
+
+def abc_xyz(keys, values, abc_cutoffs=ABC_CUTOFFS, xyz_cutoffs=XYZ_CUTOFFS):
+    """ABC class by share of total volume and XYZ class by CV, per series.
+
+    Series are ranked by volume; a series is A while the volume ranked
+    above it is under abc_cutoffs[0] of the total, B under abc_cutoffs[1],
+    else C, so the top series is always A. cv is std / mean over all
+    periods (as in sku_variability); series with no demand are Z.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    volume = values.sum(axis=1)
+    total = volume.sum()
+
+    order = np.argsort(-volume, kind='stable')
+    above = np.empty_like(volume)
+    above[order] = np.concatenate([[0.0], np.cumsum(volume[order])[:-1]])
+    share_above = above / total if total else np.ones_like(volume)
+    abc = np.select([share_above < abc_cutoffs[0], share_above < abc_cutoffs[1]], ['A', 'B'], 'C')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cv = values.std(axis=1, ddof=1) / values.mean(axis=1)
+    xyz = np.select([cv <= xyz_cutoffs[0], cv <= xyz_cutoffs[1]], ['X', 'Y'], 'Z')
+
+    frame = keys.reset_index(drop=True).copy()
+    frame['volume'] = volume
+    frame['volume_rank'] = np.argsort(order) + 1
+    frame['share'] = volume / total if total else 0.0
+    frame['cv'] = cv
+    frame['abc'] = abc
+    frame['xyz'] = xyz
+    frame['segment'] = np.char.add(abc, xyz)
+    return frame
+
+
+class SegmentIndex:
+    """ABC/XYZ tables for SKUs ('sku') and (device, SKU) series ('device_sku').
+
+    Built from the dispense AggregationCube, saved as one Parquet file per
+    level plus a JSON file with the cut-offs, and turned into a routing
+    table by routing().
+    """
+
+    LEVELS = {'sku': ('sku',), 'device_sku': ('device_id', 'sku')}
+
+    def __init__(self, tables, abc_cutoffs=ABC_CUTOFFS, xyz_cutoffs=XYZ_CUTOFFS):
+        self.tables = tables
+        self.abc_cutoffs = tuple(abc_cutoffs)
+        self.xyz_cutoffs = tuple(xyz_cutoffs)
+
+    @classmethod
+    def from_cube(cls, cube, freq='M', abc_cutoffs=ABC_CUTOFFS, xyz_cutoffs=XYZ_CUTOFFS):
+        tables = {}
+        for level, by in cls.LEVELS.items():
+            keys, _, values = series_matrix(cube, freq, by)
+            tables[level] = abc_xyz(keys, values, abc_cutoffs, xyz_cutoffs)
+        return cls(tables, abc_cutoffs, xyz_cutoffs)
+
+    def matrix(self, level='sku'):
+        """Count of series per ABC × XYZ cell."""
+        return pd.crosstab(self.tables[level]['abc'], self.tables[level]['xyz'])
+
+    def routing(self, level='device_sku', policy=None):
+        """The level's table with model, refit and refit_every columns from the policy."""
+        policy = SEGMENT_POLICY if policy is None else policy
+        table = self.tables[level].copy()
+        rules = pd.DataFrame.from_dict(policy, orient='index',
+                                       columns=['model', 'refit', 'refit_every'])
+        return table.join(rules, on='segment')
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for level, table in self.tables.items():
+            tmp = os.path.join(directory, level + '.parquet.tmp')
+            table.to_parquet(tmp, index=False)
+            os.replace(tmp, os.path.join(directory, level + '.parquet'))
+        with open(os.path.join(directory, 'cutoffs.json'), 'w') as fh:
+            json.dump({'abc': self.abc_cutoffs, 'xyz': self.xyz_cutoffs}, fh)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'cutoffs.json')) as fh:
+            cutoffs = json.load(fh)
+        tables = {level: pd.read_parquet(os.path.join(directory, level + '.parquet'))
+                  for level in cls.LEVELS}
+        return cls(tables, cutoffs['abc'], cutoffs['xyz'])
+
+
+# ---------------------------------------------------------------------------
+# Forecaster registry and rolling-origin backtesting
+# ---------------------------------------------------------------------------
+
+# name -> func(keys, periods, values, horizon, **params) returning a
+# (series × horizon) array of point forecasts
+FORECASTERS = {}
+
+
+def register_forecaster(name):
+    """Decorator adding a forecaster to FORECASTERS under name."""
+    def decorator(func):
+        FORECASTERS[name] = func
+        return func
+    return decorator
+
+
+@register_forecaster('naive')
+def _naive_forecaster(keys, periods, values, horizon):
+    return np.repeat(values[:, -1:], horizon, axis=1)
+
+
+@register_forecaster('seasonal_naive')
+def _seasonal_naive_forecaster(keys, periods, values, horizon, season=12):
+    n_time = values.shape[1]
+    if n_time < season:
+        raise ValueError('seasonal_naive needs at least one full season of history')
+    return values[:, n_time - season + np.arange(horizon) % season]
+
+
+@register_forecaster('sarima')
+def _sarima_forecaster(keys, periods, values, horizon, **params):
+    # backtest() already parallelises over folds
+    params.setdefault('n_jobs', 1)
+    frame = forecast_series(keys, periods, values, horizon, **params)
+    return (frame['forecast'].to_numpy().reshape(len(keys), horizon),
+            frame['status'].to_numpy()[::horizon])
+
+
+def _intermittent_forecaster(method):
+    def forecaster(keys, periods, values, horizon, alpha=0.1, beta=0.1):
+        level = intermittent_forecast(values, method, alpha, beta)[0]
+        return np.repeat(level[:, None], horizon, axis=1)
+    return forecaster
+
+
+for _method in INTERMITTENT_METHODS:
+    register_forecaster(_method)(_intermittent_forecaster(_method))
+
+
+@register_forecaster('global')
+def _global_forecaster(keys, periods, values, horizon, calendar, **params):
+    # daily series only; every day of the window counts as active
+    dates = periods.to_timestamp() if isinstance(periods, pd.PeriodIndex) else pd.DatetimeIndex(periods)
+    panel = DailyPanel(keys, dates, values, np.ones(values.shape, dtype=bool), 'value')
+    model = GlobalDemandModel(**params).fit(panel, calendar)
+    frame = model.forecast(panel, calendar, horizon)
+    return frame['forecast'].to_numpy().reshape(len(keys), horizon)
+
+
+# fit statuses that mean the fold had too little data, rather than a failed fit
+_SKIPPED_STATUSES = ('too_short',)
+
+
+def _backtest_task(task):
+    """Worker: one fold — forecast from the training window.
+
+    Forecasters return a (series × horizon) array, or (array, status) with a
+    per-series fit status as in forecast_series(); returns (array, status).
+    """
+    func = FORECASTERS[task['forecaster']]
+    result = func(task['keys'], task['periods'], task['values'], task['horizon'], **task['params'])
+    if isinstance(result, tuple):
+        forecasts, status = result
+    else:
+        forecasts, status = result, np.full(len(task['values']), 'ok', dtype=object)
+    return np.asarray(forecasts, dtype=np.float64), np.asarray(status, dtype=object)
+
+
+def rolling_origins(n_time, horizon, initial, step=1):
+    """Origins (training lengths) of an expanding-window backtest."""
+    return list(range(initial, n_time - horizon + 1, step))
+
+
+def forecast_errors(forecasts, actuals, scale):
+    """MAE, RMSE, MASE, WAPE and bias per series.
+
+    forecasts and actuals have shape (folds, series, horizon); scale is the
+    per-series MASE denominator. Bias is the mean of forecast - actual, so
+    a positive value means over-forecasting.
+    """
+    err = forecasts - actuals
+    # series with no forecasts (NaN throughout) or no demand come back as NaN
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mae = np.nanmean(np.abs(err), axis=(0, 2))
+        volume = np.nansum(np.abs(actuals), axis=(0, 2))
+        return {
+            'mae':  mae,
+            'rmse': np.sqrt(np.nanmean(err ** 2, axis=(0, 2))),
+            'mase': np.where(scale > 0, mae / scale, np.nan),
+            'wape': np.where(volume > 0, np.nansum(np.abs(err), axis=(0, 2)) / volume, np.nan),
+            'bias': np.nanmean(err, axis=(0, 2)),
+        }
+
+
+def backtest(keys, periods, values, forecaster, horizon=3, initial=None, step=1,
+             mase_season=1, fallback_window=12, n_jobs=None, **params):
+    """Rolling-origin (expanding window) cross-validation of a registered forecaster.
+
+    Each origin trains on values[:, :origin] and forecasts the next horizon
+    periods; folds run across worker processes via run_batched(). initial
+    defaults to half the history. MASE is scaled by each series' in-sample
+    mean absolute naive difference at lag mase_season over the first
+    training window. Returns one row per series: the keys, forecaster, number of
+    folds, fallback_folds, failed_folds, status and the forecast_errors()
+    metrics. A fold fails for a series when the forecaster rejects its fit
+    (e.g. a 'nonstationary' SARIMA) or its forecasts exceed ten times the
+    largest value in the training window. Failed folds, and folds with no
+    forecast (e.g. too short to fit), are scored with the fallback the
+    pipeline uses in their place, the mean of the last fallback_window
+    training periods, so every forecaster is scored on every fold. status
+    is 'ok' (no failed folds), 'partial' (some) or 'failed' (all). Extra
+    keyword arguments go to the forecaster.
+    """
+    if forecaster not in FORECASTERS:
+        raise KeyError('unknown forecaster %r; registered: %s' % (forecaster, sorted(FORECASTERS)))
+    values = np.asarray(values, dtype=np.float64)
+    n_time = values.shape[1]
+    initial = n_time // 2 if initial is None else initial
+    origins = rolling_origins(n_time, horizon, initial, step)
+    if not origins:
+        raise ValueError('no fold fits: %d periods, initial=%d, horizon=%d' % (n_time, initial, horizon))
+
+    tasks = [
+        {
+            'forecaster': forecaster,
+            'keys':       keys,
+            'periods':    periods[:origin],
+            'values':     values[:, :origin],
+            'horizon':    horizon,
+            'params':     params,
+        }
+        for origin in origins
+    ]
+    folds = run_batched(_backtest_task, tasks, n_jobs=n_jobs, batch_size=1)
+    forecasts = np.stack([f for f, _ in folds])
+    fit_status = np.stack([s for _, s in folds])
+    actuals = np.stack([values[:, origin:origin + horizon] for origin in origins])
+
+    # a fold fails for a series when its fit was rejected (e.g. 'nonstationary') or its
+    # forecasts run past ten times anything in the training window; those folds, and
+    # folds with no forecast at all, are scored with the trailing-mean fallback the
+    # pipeline would use instead, so every forecaster is compared on the same folds
+    ceiling = np.stack([10 * np.abs(values[:, :origin]).max(axis=1, keepdims=True) + 1
+                        for origin in origins])
+    with np.errstate(invalid='ignore'):
+        diverged = (np.abs(forecasts) > ceiling).any(axis=2)
+    rejected = ~np.isin(fit_status, ('ok', 'constant') + _SKIPPED_STATUSES)
+    failed = diverged | rejected
+    replaced = failed[:, :, None] | ~np.isfinite(forecasts)
+    fallback = np.stack([values[:, max(origin - fallback_window, 0):origin].mean(axis=1, keepdims=True)
+                         for origin in origins])
+    forecasts = np.where(replaced, fallback, forecasts)
+    failed_folds = failed.sum(axis=0)
+    fallback_folds = replaced.any(axis=2).sum(axis=0)
+
+    history = values[:, :initial]
+    scale = np.abs(history[:, mase_season:] - history[:, :-mase_season]).mean(axis=1)
+
+    frame = keys.reset_index(drop=True).copy()
+    frame['forecaster'] = forecaster
+    frame['folds'] = len(origins)
+    frame['fallback_folds'] = fallback_folds
+    frame['failed_folds'] = failed_folds
+    frame['status'] = np.select([failed_folds == len(origins), failed_folds > 0], ['failed', 'partial'], 'ok')
+    for name, metric in forecast_errors(forecasts, actuals, scale).items():
+        frame[name] = metric
+    return frame
+
+
+# ---------------------------------------------------------------------------
+# Hierarchical reconciliation: (device, sku) leaves -> device / sku -> fleet
+# ---------------------------------------------------------------------------
+
+# aggregation levels above the leaves, coarsest first
+HIERARCHY_LEVELS = (('fleet', ()), ('device', ('device_id',)), ('sku', ('sku',)))
+RECONCILE_METHODS = ('bottom_up', 'top_down', 'ols', 'wls_struct', 'mint')
+
+
+class Hierarchy:
+    """Sparse summing matrix over (device, sku) leaf series.
+
+    Rows of S are the nodes: the fleet total, one per device, one per SKU
+    and finally one per leaf (an identity block), in the order of the nodes
+    table (level, device_id, sku; NaN where a level sums over that column).
+    Any node history or forecast is S @ leaf values. Only the nonzeros are
+    stored, one per (node, leaf) pair, so thousands of leaves fit easily.
+    """
+
+    def __init__(self, leaves, levels=HIERARCHY_LEVELS):
+        from scipy import sparse
+
+        self.leaves = leaves.reset_index(drop=True)
+        n_leaves = len(self.leaves)
+        blocks, node_frames = [], []
+        for name, columns in levels:
+            if columns:
+                codes, uniques = pd.factorize(pd.MultiIndex.from_frame(self.leaves[list(columns)]), sort=True)
+                nodes = uniques.to_frame(index=False, name=list(columns))
+            else:
+                codes, nodes = np.zeros(n_leaves, dtype=np.intp), pd.DataFrame(index=[0])
+            blocks.append(sparse.csr_matrix((np.ones(n_leaves), (codes, np.arange(n_leaves))),
+                                            shape=(len(nodes), n_leaves)))
+            node_frames.append(nodes.assign(level=name))
+        self.n_aggregate = sum(b.shape[0] for b in blocks)
+        blocks.append(sparse.identity(n_leaves, format='csr'))
+        node_frames.append(self.leaves.assign(level='leaf'))
+
+        self.S = sparse.vstack(blocks, format='csr')
+        nodes = pd.concat(node_frames, ignore_index=True)
+        self.nodes = nodes[['level'] + [c for c in self.leaves.columns]]
+        for col in self.leaves.columns:
+            self.nodes[col] = self.nodes[col].astype(self.leaves[col].dtype)
+
+    @property
+    def shape(self):
+        return self.S.shape
+
+    def aggregate(self, leaf_values):
+        """Node values (nodes × time) from leaf values (leaves × time)."""
+        return np.asarray(self.S @ np.asarray(leaf_values, dtype=np.float64))
+
+    def reconcile(self, base, method='mint', weights=None, history=None):
+        """Coherent forecasts for every node from base forecasts for every node.
+
+        base has shape (nodes × horizon), rows in nodes order. Methods:
+        'bottom_up' sums the leaf forecasts; 'top_down' splits the fleet
+        forecast by each leaf's share of history (leaves × time); 'ols',
+        'wls_struct' (weights = leaves under each node) and 'mint' are the
+        generalised least-squares projection S (S' W⁻¹ S)⁻¹ S' W⁻¹ base with
+        W diagonal: identity, structural, or weights, the per-node error
+        variances (e.g. backtest rmse ** 2). A full MinT covariance would be
+        dense over the leaves, so 'mint' uses its diagonal. The solve uses
+        the Woodbury identity around the leaf block, so the only dense
+        matrix is (aggregate nodes × aggregate nodes).
+
+        Returns (nodes × horizon) reconciled forecasts.
+        """
+        if method not in RECONCILE_METHODS:
+            raise ValueError('method must be one of %s' % (RECONCILE_METHODS,))
+        base = np.asarray(base, dtype=np.float64)
+        if base.ndim == 1:
+            base = base[:, None]
+        n_agg = self.n_aggregate
+
+        if method == 'bottom_up':
+            return self.aggregate(base[n_agg:])
+        if method == 'top_down':
+            if history is None:
+                raise ValueError("top_down needs the leaf history for its proportions")
+            totals = np.asarray(history, dtype=np.float64).sum(axis=1)
+            share = totals / totals.sum()
+            return self.aggregate(share[:, None] * base[:1])
+
+        if method == 'ols':
+            w = np.ones(self.S.shape[0])
+        elif method == 'wls_struct':
+            w = np.asarray(self.S.sum(axis=1)).ravel()
+        else:
+            if weights is None:
+                raise ValueError('mint needs per-node error variances as weights')
+            w = np.asarray(weights, dtype=np.float64)
+            # nodes without an error estimate get the median variance of their level
+            fill = pd.Series(w).groupby(self.nodes['level'].to_numpy()).transform('median')
+            w = np.where(np.isfinite(w) & (w > 0), w, fill.to_numpy())
+            w = np.where(np.isfinite(w) & (w > 0), w, 1.0)
+
+        # S' W^-1 S = W_leaf^-1 + A' W_agg^-1 A with A the aggregate rows, so
+        # (S' W^-1 S)^-1 = W_leaf - W_leaf A' (W_agg + A W_leaf A')^-1 A W_leaf
+        A = self.S[:n_agg]
+        w_agg, w_leaf = w[:n_agg], w[n_agg:]
+        rhs = A.T @ (base[:n_agg] / w_agg[:, None]) + base[n_agg:] / w_leaf[:, None]
+        inner = np.diag(w_agg) + (A.multiply(w_leaf[None, :]) @ A.T).toarray()
+        y = w_leaf[:, None] * rhs
+        leaves = y - w_leaf[:, None] * (A.T @ np.linalg.solve(inner, A @ y))
+        return self.aggregate(leaves)
@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+"""Inventory policy for the (device, SKU) series.
+
+Restock intervals per device come from the restock log and set each
+device's review period; combined with each series' forecast demand and
+forecast error they give safety stock, reorder point and order-up-to
+level for a target service level. Every
+quantity is computed for all (device, SKU, period) rows at once, so the
+whole fleet can be re-planned after each nightly forecast.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# average days per calendar month, to turn monthly forecasts into daily rates
+DAYS_PER_MONTH = 365.25 / 12
+
+
+def _z_score(service_level):
+    from scipy.stats import norm
+
+    service_level = np.asarray(service_level, dtype=np.float64)
+    if np.any((service_level <= 0) | (service_level >= 1)):
+        raise ValueError('service_level must lie strictly between 0 and 1')
+    return norm.ppf(service_level)
+
+
+def restock_lead_times(df, date_col='restock_date', by='device_id'):
+    """Days between consecutive restock visits, summarised per device.
+
+    Several restock orders on the same day count as one visit. Returns a
+    frame indexed by device with n_visits, lead_time_mean and
+    lead_time_std (days); devices with fewer than two visits get NaN
+    (fewer than three, a NaN std).
+    """
+    visits = (
+        pd.DataFrame({by: df[by].to_numpy(), 'day': df[date_col].dt.normalize().to_numpy()})
+          .astype({by: df[by].dtype})
+          .drop_duplicates()
+          .sort_values([by, 'day'], kind='stable')
+    )
+    codes, devices = pd.factorize(visits[by], sort=True)
+    days = visits['day'].to_numpy().astype('datetime64[D]').astype(np.int64)
+
+    # interval to the previous visit of the same device, NaN on its first visit
+    gaps = np.empty(len(days))
+    gaps[:1] = np.nan
+    gaps[1:] = np.diff(days)
+    gaps[np.r_[True, codes[1:] != codes[:-1]]] = np.nan
+
+    n_devices = len(devices)
+    valid = ~np.isnan(gaps)
+    n_gaps = np.bincount(codes[valid], minlength=n_devices).astype(np.float64)
+    total = np.bincount(codes[valid], weights=gaps[valid], minlength=n_devices)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n_gaps
+        sq = np.bincount(codes[valid], weights=(gaps[valid] - mean[codes[valid]]) ** 2,
+                         minlength=n_devices)
+        std = np.sqrt(sq / (n_gaps - 1))
+    std[n_gaps < 2] = np.nan
+
+    return pd.DataFrame({
+        'n_visits':       np.bincount(codes, minlength=n_devices),
+        'lead_time_mean': mean,
+        'lead_time_std':  std,
+    }, index=pd.Index(devices, name=by))
+
+
+def inventory_policy(forecasts, errors, lead_times, service_level=0.95, review_days=None,
+                     lead_days=0.0, period_days=DAYS_PER_MONTH, error_col='wape',
+                     max_error_ratio=3.0, by=('device_id', 'sku')):
+    """Safety stock, reorder point and order-up-to level per (series, forecast period).
+
+    forecasts is a long forecast frame (forecast_series(),
+    forecast_intermittent()) with the ``by`` columns and a per-period
+    'forecast', which must be finite (fill rejected fits first); errors
+    holds one relative forecast error per series in error_col (e.g.
+    backtest()'s wape, mean absolute error over mean demand); lead_times
+    is restock_lead_times(). The period error is sqrt(pi/2) * wape *
+    forecast — sqrt(pi/2) turns a mean absolute error into a normal
+    standard deviation — so it grows and shrinks with the forecast. Demand
+    per day is the period forecast over period_days, with daily errors
+    taken as independent.
+
+    Each device is reviewed (visited) every R days and a refill decided at
+    a visit lands lead_days = L later (0: the driver refills on the spot).
+    R is by default the device's mean restock interval mu_R with std
+    sigma_R, as estimated by restock_lead_times(); passing review_days
+    overrides it with a fixed interval. Stock has to cover the R + L days
+    until the next refill arrives:
+
+        safety_stock  = z * sqrt((R + L) * sigma_d**2 + d**2 * sigma_R**2)
+        reorder_point = d * L + safety_stock
+        order_up_to   = d * (R + L) + safety_stock
+
+    where z is the normal quantile of service_level (a scalar or one value
+    per row); sigma_R is 0 when review_days is given. Devices with no
+    usable restock history take the fleet median interval.
+
+    Errors from backtest rows whose status is not 'ok' are ignored; those
+    series, and series without an error, use a Poisson error sqrt(forecast)
+    per period. The period error is capped at max_error_ratio times
+    max(forecast, 1), so one badly fitted series cannot blow up its
+    safety stock. As both demand and its error scale with each period's
+    forecast, safety stock follows the seasonal forecast.
+    """
+    by = list(by)
+    if 'status' in errors.columns:
+        errors = errors[errors['status'].eq('ok')]
+    frame = forecasts.merge(errors[by + [error_col]], on=by, how='left')
+
+    if review_days is None:
+        fleet = lead_times[['lead_time_mean', 'lead_time_std']].median()
+        interval = lead_times[['lead_time_mean', 'lead_time_std']].reindex(frame['device_id'])
+        review = interval['lead_time_mean'].fillna(fleet['lead_time_mean']).to_numpy()
+        sigma_r = interval['lead_time_std'].fillna(fleet['lead_time_std']).fillna(0.0).to_numpy()
+    else:
+        review = np.broadcast_to(np.asarray(review_days, dtype=np.float64), len(frame))
+        sigma_r = np.zeros(len(frame))
+    lead = np.broadcast_to(np.asarray(lead_days, dtype=np.float64), len(frame))
+
+    period_demand = np.maximum(frame['forecast'].to_numpy(dtype=np.float64), 0.0)
+    relative_error = frame[error_col].to_numpy(dtype=np.float64)
+    period_error = np.where(np.isfinite(relative_error),
+                            np.sqrt(np.pi / 2) * relative_error * period_demand,
+                            np.sqrt(period_demand))
+    period_error = np.minimum(period_error, max_error_ratio * np.maximum(period_demand, 1.0))
+
+    d = period_demand / period_days
+    sigma_d = period_error / np.sqrt(period_days)
+    z = _z_score(service_level)
+    cover = review + lead
+
+    safety_stock = z * np.sqrt(cover * sigma_d ** 2 + d ** 2 * sigma_r ** 2)
+
+    frame['daily_demand'] = d
+    frame['daily_std'] = sigma_d
+    frame['review_days'] = review
+    frame['review_std'] = sigma_r
+    frame['lead_days'] = lead
+    frame['service_level'] = np.broadcast_to(service_level, len(frame))
+    frame['safety_stock'] = safety_stock
+    frame['reorder_point'] = d * lead + safety_stock
+    frame['order_up_to'] = d * cover + safety_stock
+    return frame
+
+
+# ---------------------------------------------------------------------------
+# Restock run planning
+# ---------------------------------------------------------------------------
+
+def days_to_stockout(on_hand, daily_demand, daily_std, risk=0.05):
+    """Days until the chance of having run out first exceeds risk, per item.
+
+    Demand over t days is taken as normal with mean d*t and std
+    sigma*sqrt(t), so the answer is the t solving
+    d*t + z*sigma*sqrt(t) = on_hand with z the (1 - risk) quantile: a
+    quadratic in sqrt(t). Items with no demand and no spread never run out
+    (inf), even when empty; other items already empty are due now (0).
+    """
+    on_hand = np.maximum(np.asarray(on_hand, dtype=np.float64), 0.0)
+    d = np.maximum(np.asarray(daily_demand, dtype=np.float64), 0.0)
+    spread = _z_score(1.0 - risk) * np.nan_to_num(np.asarray(daily_std, dtype=np.float64))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # the numerically stable root of d*u**2 + spread*u - on_hand = 0
+        root = 2.0 * on_hand / (spread + np.sqrt(spread ** 2 + 4.0 * d * on_hand))
+    root = np.where((d == 0) & (spread == 0), np.inf, np.where(on_hand == 0, 0.0, root))
+    return root ** 2
+
+
+def _visit_day(due, current, weekdays, start_weekday):
+    """Latest allowed day in [current, due], else the first allowed day after current."""
+    for day in range(int(due), current - 1, -1):
+        if (start_weekday + day) % 7 in weekdays:
+            return day
+    day = current
+    while (start_weekday + day) % 7 not in weekdays:
+        day += 1
+    return day
+
+
+def plan_restocks(items, start, horizon_days=28, risk=0.05, max_stops=None, max_units=None,
+                  max_pull_days=7, visit_weekdays=(0, 1, 2, 3, 4)):
+    """Group device visits into restock runs over the next horizon_days.
+
+    items has one row per (device, SKU) with device_id, on_hand,
+    daily_demand, daily_std and order_up_to (e.g. inventory_policy()'s
+    first forecast month plus an on-hand estimate). A device is due the
+    day before any of its SKUs crosses the stockout risk (see
+    days_to_stockout()); a visit tops every SKU on the device up to
+    order_up_to.
+
+    The heuristic works through the fleet by deadline. Each run goes out
+    on the latest allowed weekday that still meets the most urgent
+    device's deadline, then takes every other device due within
+    max_pull_days of that day, most urgent first, until max_stops devices
+    or max_units units are loaded. Devices left over by the capacity
+    limits are due again at once and get the next run. Pulling visits
+    forward is what keeps the number of runs down; max_pull_days bounds
+    how much stock is topped up early.
+
+    Returns (runs, visits): runs has one row per run (run, date, stops,
+    units); visits one row per device visit (run, date, device_id, units,
+    due_date and late, True when no allowed day met the deadline).
+    """
+    start = pd.Timestamp(start).normalize()
+    device_codes, devices = pd.factorize(items['device_id'], sort=True)
+    n_devices = len(devices)
+    d = np.maximum(items['daily_demand'].to_numpy(dtype=np.float64), 0.0)
+    sigma = items['daily_std'].to_numpy(dtype=np.float64)
+    target = items['order_up_to'].to_numpy(dtype=np.float64)
+
+    # level at base_day; after a visit each SKU restarts from its order-up-to level
+    base_day = np.zeros(len(items))
+    base_level = items['on_hand'].to_numpy(dtype=np.float64, copy=True)
+    # a device is visited at most once a day
+    earliest = np.zeros(n_devices, dtype=np.int64)
+    weekdays = set(visit_weekdays)
+    current = 0
+    runs, visits = [], []
+
+    while True:
+        # the tolerance keeps a cover of exactly k days from rounding down to k - 1
+        item_due = np.floor(base_day + days_to_stockout(base_level, d, sigma, risk) + 1e-9) - 1
+        due = np.full(n_devices, np.inf)
+        np.minimum.at(due, device_codes, item_due)
+        urgent = int(np.argmin(due))
+        if not due[urgent] < horizon_days:
+            break
+
+        lower = max(current, int(earliest[urgent]))
+        day = _visit_day(max(due[urgent], lower), lower, weekdays, start.dayofweek)
+        if day >= horizon_days:
+            break
+        eligible = (due <= day + max_pull_days) & (earliest <= day)
+        eligible[urgent] = True
+        candidates = np.flatnonzero(eligible)
+        candidates = candidates[np.argsort(due[candidates], kind='stable')]
+
+        level = np.maximum(base_level - d * (day - base_day), 0.0)
+        fill = np.maximum(target - level, 0.0)
+        units = np.bincount(device_codes, weights=fill, minlength=n_devices)[candidates]
+        take = np.ones(len(candidates), dtype=bool)
+        if max_stops is not None:
+            take[max_stops:] = False
+        if max_units is not None:
+            # the first device always goes, even when it alone exceeds max_units
+            take[1:] &= np.cumsum(units)[1:] <= max_units
+        chosen, units = candidates[take], units[take]
+
+        run = len(runs)
+        date = start + pd.Timedelta(days=day)
+        runs.append({'run': run, 'date': date, 'stops': len(chosen), 'units': units.sum()})
+        for device, device_units in zip(chosen, units):
+            visits.append({
+                'run':       run,
+                'date':      date,
+                'device_id': devices[device],
+                'units':     device_units,
+                'due_date':  start + pd.Timedelta(days=float(due[device])),
+                'late':      day > due[device],
+            })
+
+        refreshed = np.isin(device_codes, chosen)
+        base_day[refreshed] = day
+        base_level[refreshed] = target[refreshed]
+        earliest[chosen] = day + 1
+        current = day
+
+    runs = pd.DataFrame(runs, columns=['run', 'date', 'stops', 'units'])
+    visits = pd.DataFrame(visits, columns=['run', 'date', 'device_id', 'units', 'due_date', 'late'])
+    visits['device_id'] = visits['device_id'].astype(items['device_id'].dtype)
+    return runs, visits
+
+
+# ---------------------------------------------------------------------------
+# Monte Carlo stockout risk
+# ---------------------------------------------------------------------------
+
+def visit_mask(items, visits, start, horizon_days):
+    """(item × day) bool array, True on days a planned visit tops the item's device up."""
+    start = pd.Timestamp(start).normalize()
+    mask = np.zeros((len(items), horizon_days), dtype=bool)
+    day = ((visits['date'] - start) // pd.Timedelta(days=1)).to_numpy()
+    inside = (day >= 0) & (day < horizon_days)
+    device = visits['device_id'].astype(str).to_numpy()[inside]
+    hit = pd.DataFrame({'device': device, 'day': day[inside]})
+    rows = pd.DataFrame({'device': items['device_id'].astype(str).to_numpy(),
+                         'row': np.arange(len(items))}).merge(hit, on='device')
+    mask[rows['row'].to_numpy(), rows['day'].to_numpy()] = True
+    return mask
+
+
+def _bootstrap(residuals, size, rng):
+    """Draws from each row's non-NaN residuals, shape size + (series, horizon)."""
+    residuals = np.asarray(residuals, dtype=np.float64)
+    valid = ~np.isnan(residuals)
+    count = valid.sum(axis=1)
+    if np.any(count == 0):
+        raise ValueError('every series needs at least one non-NaN residual')
+    # move each row's valid residuals to the front, then pick uniformly among them
+    packed = np.take_along_axis(residuals, np.argsort(~valid, axis=1, kind='stable'), axis=1)
+    pick = (rng.random(size) * count[:, None]).astype(np.intp)
+    return packed[np.arange(len(packed))[:, None], pick]
+
+
+def simulate_stockouts(keys, on_hand, demand_mean, demand_std=None, residuals=None,
+                       restock=None, target=None, n_paths=1000, seed=0):
+    """Stockout probability and expected shortage from simulated demand paths.
+
+    demand_mean is a (series × horizon) array of expected demand per
+    period. Each path adds noise to it: normal with demand_std (per series
+    or per period), or, with residuals given, draws from each series' own
+    residuals, e.g. the resid of a seasonal decomposition (NaN edges are
+    skipped). Demand is floored at 0. restock is an optional (series ×
+    horizon) bool array (see visit_mask()) marking periods that start with
+    the stock topped up to target; unmet demand is lost, not backordered.
+
+    Between top-ups the stock only falls, so each segment's shortfall is its
+    cumulative demand beyond the level it started at, and all n_paths ×
+    series × horizon cells are evaluated as array operations with no loop
+    over paths or periods. Returns keys with stockout_prob (chance of running
+    out at least once), expected_shortage (lost units), expected_demand and
+    fill_rate.
+    """
+    demand_mean = np.asarray(demand_mean, dtype=np.float64)
+    n_series, horizon = demand_mean.shape
+    on_hand = np.broadcast_to(np.asarray(on_hand, dtype=np.float64), (n_series,))
+    rng = np.random.default_rng(seed)
+    size = (n_paths, n_series, horizon)
+
+    if residuals is not None:
+        noise = _bootstrap(residuals, size, rng)
+    elif demand_std is not None:
+        std = np.asarray(demand_std, dtype=np.float64)
+        noise = rng.standard_normal(size) * (std[:, None] if std.ndim == 1 else std)
+    else:
+        raise ValueError('pass demand_std or residuals')
+    demand = noise
+    demand += demand_mean
+    np.maximum(demand, 0.0, out=demand)
+    expected_demand = demand.sum(axis=2).mean(axis=0)
+
+    # cumulative demand since the most recent top-up (or since the start)
+    since = np.cumsum(demand, axis=2)
+    if restock is not None and np.any(restock):
+        if target is None:
+            raise ValueError('restock needs the target levels to top up to')
+        restock = np.asarray(restock, dtype=bool)
+        target = np.broadcast_to(np.asarray(target, dtype=np.float64), (n_series,))
+        seg_start = np.maximum.accumulate(np.where(restock, np.arange(horizon), 0), axis=1)
+        since -= np.take_along_axis(since - demand, np.broadcast_to(seg_start, size), axis=2)
+        started = np.cumsum(restock, axis=1) > 0
+        level = np.where(started, target[:, None], on_hand[:, None]) - since
+    else:
+        restock = np.zeros((n_series, horizon), dtype=bool)
+        level = on_hand[:, None] - since
+
+    # shortfall is only booked at the last period of each segment
+    seg_end = np.ones((n_series, horizon), dtype=bool)
+    seg_end[:, :-1] = restock[:, 1:]
+    shortage = np.where(seg_end, np.maximum(-level, 0.0), 0.0).sum(axis=2)
+
+    expected_shortage = shortage.mean(axis=0)
+    frame = keys.reset_index(drop=True).copy()
+    frame['stockout_prob'] = (level < 0).any(axis=2).mean(axis=0)
+    frame['expected_shortage'] = expected_shortage
+    frame['expected_demand'] = expected_demand
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frame['fill_rate'] = np.where(expected_demand > 0, 1.0 - expected_shortage / expected_demand, 1.0)
+    return frame
+
+
+# ---------------------------------------------------------------------------
+# Implied on-hand ledger
+# ---------------------------------------------------------------------------
+
+def _daily_matrix(cube, devices, dates):
+    """The cube's per-(device, day) sums scattered into a (device × day) array."""
+    daily = cube.rollup('D', ('device_id',))[cube.value_col]
+    day = daily.index.get_level_values('period').to_timestamp()
+    rows = devices.get_indexer(daily.index.get_level_values('device_id'))
+    cols = dates.get_indexer(day)
+    keep = (rows >= 0) & (cols >= 0)
+    out = np.zeros((len(devices), len(dates)))
+    np.add.at(out, (rows[keep], cols[keep]), daily.to_numpy(dtype=np.float64)[keep])
+    return out
+
+
+class InventoryLedger:
+    """Implied on-hand level per device and day, from dispenses and restocks.
+
+    Attributes
+    ----------
+    devices : Index
+        One entry per device (rows of the arrays).
+    dates : DatetimeIndex
+        Contiguous daily calendar (columns of the arrays).
+    dispensed, restocked : ndarray, float64, shape (len(devices), len(dates))
+        Daily totals of qty_dispensed and restock total.
+    opening : ndarray, float64, shape (len(devices),)
+        Level before the first day.
+    on_hand : ndarray, float64, same shape as dispensed
+        Level at the end of each day: opening + cumulative restocked -
+        cumulative dispensed.
+
+    The logs carry no stock counts, so the opening level is implied: by
+    default the smallest one that keeps the device's level from going
+    negative, i.e. the device is taken to have run empty once. Restock
+    totals are multiplied by restock_scale (a scalar or one factor per
+    device) to turn them into units; 'balance' picks, per device, the
+    factor that makes restocked equal dispensed over the whole ledger,
+    for when totals are money rather than units. Queries are positional
+    lookups into the arrays.
+    """
+
+    def __init__(self, devices, dates, dispensed, restocked, opening=None, restock_scale=1.0):
+        self.devices = pd.Index(devices, name='device_id')
+        self.dates = pd.DatetimeIndex(dates, name='date')
+        self.dispensed = np.asarray(dispensed, dtype=np.float64)
+        restocked = np.asarray(restocked, dtype=np.float64)
+        if isinstance(restock_scale, str):
+            if restock_scale != 'balance':
+                raise ValueError("restock_scale must be a number, an array or 'balance'")
+            total = restocked.sum(axis=1)
+            restock_scale = np.divide(self.dispensed.sum(axis=1), total,
+                                      out=np.ones_like(total), where=total > 0)
+        self.restock_scale = np.broadcast_to(np.asarray(restock_scale, dtype=np.float64),
+                                             (len(self.devices),)).copy()
+        self.restocked = restocked * self.restock_scale[:, None]
+        net = np.cumsum(self.restocked - self.dispensed, axis=1)
+        if opening is None:
+            opening = np.maximum(-net.min(axis=1, initial=0.0), 0.0)
+        self.opening = np.broadcast_to(np.asarray(opening, dtype=np.float64), (len(self.devices),)).copy()
+        self.on_hand = self.opening[:, None] + net
+
+    @classmethod
+    def from_cubes(cls, inv_cube, rest_cube, start=None, end=None, opening=None, restock_scale=1.0):
+        """Build from the dispense and restock AggregationCubes.
+
+        start defaults to the first restock: dispenses before the restock
+        history begins cannot be balanced against anything. end defaults to
+        the earlier of the two feeds' last days, for the same reason: past
+        it one feed is missing, and the level would only ever rise (or fall).
+        """
+        inv_days = inv_cube.base.index.get_level_values('date')
+        rest_days = rest_cube.base.index.get_level_values('date')
+        start = rest_days.min() if start is None else pd.Timestamp(start).normalize()
+        end = min(inv_days.max(), rest_days.max()) if end is None else pd.Timestamp(end).normalize()
+        dates = pd.date_range(start, end, freq='D')
+
+        inv_devices = inv_cube.base.index.get_level_values('device_id')
+        devices = inv_devices.unique().union(rest_cube.base.index.get_level_values('device_id').unique())
+        devices = pd.Index(devices.sort_values(), name='device_id')
+        return cls(devices, dates, _daily_matrix(inv_cube, devices, dates),
+                   _daily_matrix(rest_cube, devices, dates), opening, restock_scale)
+
+    @property
+    def shape(self):
+        return self.on_hand.shape
+
+    def level(self, device_id, date):
+        """End-of-day level for each (device_id, date) pair; NaN outside the ledger."""
+        rows = self.devices.get_indexer(pd.Index(np.atleast_1d(device_id)))
+        days = pd.DatetimeIndex(np.atleast_1d(pd.to_datetime(date))).normalize()
+        cols = ((days - self.dates[0]) // pd.Timedelta(days=1)).to_numpy()
+        rows, cols = np.broadcast_arrays(rows, cols)
+        ok = (rows >= 0) & (cols >= 0) & (cols < len(self.dates))
+        out = np.full(rows.shape, np.nan)
+        out[ok] = self.on_hand[rows[ok], cols[ok]]
+        return out
+
+    def at(self, date):
+        """Every device's end-of-day level on date, as a Series."""
+        return pd.Series(self.level(self.devices, date), index=self.devices, name='on_hand')
+
+    def current(self):
+        """Every device's level at the end of the ledger."""
+        return pd.Series(self.on_hand[:, -1], index=self.devices, name='on_hand')
+
+    def to_frame(self):
+        """Long table: device_id, date, dispensed, restocked, on_hand."""
+        n_devices, n_days = self.shape
+        return pd.DataFrame({
+            'device_id': np.repeat(self.devices.to_numpy(), n_days),
+            'date':      np.tile(self.dates.to_numpy(), n_devices),
+            'dispensed': self.dispensed.ravel(),
+            'restocked': self.restocked.ravel(),
+            'on_hand':   self.on_hand.ravel(),
+        }).astype({'device_id': self.devices.dtype})
+
+    def cycles(self):
+        """Each dispense day tagged with the device's latest restock, via merge_asof.
+
+        Columns: device_id, date, dispensed, on_hand, last_restock,
+        restock_total, level_after_restock (end of the restock day),
+        days_since_restock and dispensed_since_restock (including the day
+        itself; a restock on the same day counts as earlier). Days before a
+        device's first restock have NaT / NaN restock fields.
+        """
+        frame = self.to_frame()
+        frame['date'] = frame['date'].astype('datetime64[ns]')
+        frame['device_id'] = frame['device_id'].astype(str)
+        restocks = frame.loc[frame['restocked'] > 0, ['device_id', 'date', 'restocked', 'on_hand']]
+        restocks = restocks.rename(columns={'restocked': 'restock_total',
+                                            'on_hand': 'level_after_restock'})
+        restocks['last_restock'] = restocks['date']
+        dispenses = frame.loc[frame['dispensed'] > 0, ['device_id', 'date', 'dispensed', 'on_hand']]
+
+        tagged = pd.merge_asof(dispenses.sort_values('date'), restocks.sort_values('date'),
+                               on='date', by='device_id', direction='backward')
+        tagged = tagged.sort_values(['device_id', 'date'], kind='stable').reset_index(drop=True)
+        tagged['days_since_restock'] = (tagged['date'] - tagged['last_restock']).dt.days
+        tagged['dispensed_since_restock'] = (
+            tagged.groupby(['device_id', tagged['last_restock'].fillna(pd.Timestamp(0))])['dispensed']
+                  .cumsum()
+        )
+        tagged['device_id'] = tagged['device_id'].astype(self.devices.dtype)
+        return tagged[['device_id', 'date', 'dispensed', 'on_hand', 'last_restock', 'restock_total',
+                       'level_after_restock', 'days_since_restock', 'dispensed_since_restock']]
+
+    def save(self, path):
+        """Write the arrays to one compressed .npz file (restocked already in units)."""
+        tmp = path + '.tmp.npz'
+        np.savez_compressed(
+            tmp,
+            devices=np.asarray(self.devices.astype(str), dtype=str),
+            start=np.datetime64(self.dates[0], 'D'),
+            dispensed=self.dispensed,
+            restocked=self.restocked,
+            opening=self.opening,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            dates = pd.date_range(pd.Timestamp(data['start'].item()), periods=data['dispensed'].shape[1], freq='D')
+            return cls(data['devices'], dates, data['dispensed'], data['restocked'], data['opening'])
@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+"""Loading helpers for the vending dispense and restock feeds.
+
+Both CSVs are read exactly once, with the column dtypes and date formats
+declared up front so pandas never has to infer them row by row. The cleaned
+frames are cached as Parquet next to the source file and reused for as long
+as the source is unchanged. Nightly log files can be appended to a stored
+history incrementally, updating the daily and monthly tables in place, and
+logs too large for memory can be rolled up chunk by chunk. The long hex ids
+are interned once into dense integer codes shared by both feeds.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# dispense_date is DD-MM-YYYY; restock_date carries microseconds
+DISPENSE_DATE_FORMAT = '%d-%m-%Y'
+RESTOCK_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+INVENTORY_DTYPES = {
+    'sku':           'category',
+    'device_id':     'category',
+    'package_qty':   'int32',
+    'qty_dispensed': 'int32',
+}
+
+RESTOCK_DTYPES = {
+    'device_id':       'category',
+    'global_order_id': 'string',
+    'currency_code':   'category',
+    'total':           'float64',
+}
+
+
+def _read_typed_csv(path, dtypes, date_col, date_format, usecols=None):
+    """Read one CSV in a single pass with declared dtypes and a fixed date format."""
+    if usecols is not None:
+        usecols = list(usecols)
+        if date_col not in usecols:
+            usecols.append(date_col)
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in usecols}
+
+    df = pd.read_csv(
+        path,
+        usecols=usecols,
+        dtype=dtypes,
+        encoding='utf-8-sig',     # Inventory_Turnover.csv starts with a BOM
+    )
+    df[date_col] = pd.to_datetime(df[date_col], format=date_format)
+    return df
+
+
+def load_inventory(path='/content/Inventory_Turnover.csv', usecols=None):
+    """Load the dispense log: categorical sku/device_id, int32 quantities,
+    dispense_date parsed as DD-MM-YYYY."""
+    return _read_typed_csv(path, INVENTORY_DTYPES, 'dispense_date',
+                           DISPENSE_DATE_FORMAT, usecols=usecols)
+
+
+def load_restock(path='/content/Restock_data.csv', usecols=None):
+    """Load the restock log: categorical device_id, float64 totals,
+    restock_date parsed with its microsecond timestamp."""
+    return _read_typed_csv(path, RESTOCK_DTYPES, 'restock_date',
+                           RESTOCK_DATE_FORMAT, usecols=usecols)
+
+
+# ---------------------------------------------------------------------------
+# Columnar cache of the cleaned frames
+# ---------------------------------------------------------------------------
+
+CACHE_DIRNAME = '.vending_cache'
+
+
+def clean_inventory(df):
+    """Step 2 cleaning: drop exact duplicate rows, index by dispense_date."""
+    df = df.drop_duplicates()
+    df.index = df['dispense_date']
+    return df
+
+
+def clean_restock(df):
+    """Step 2 cleaning: drop exact duplicate rows, index by restock_date."""
+    df = df.drop_duplicates()
+    df.index = df['restock_date']
+    return df
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """Size, mtime and SHA-256 of a source file, used as the cache key."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return {
+        'size':     stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256':   digest.hexdigest(),
+    }
+
+
+def _cache_paths(path, cache_dir):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return (cache_dir,
+            os.path.join(cache_dir, stem + '.parquet'),
+            os.path.join(cache_dir, stem + '.json'))
+
+
+def _cache_is_fresh(path, manifest_path, verify_hash):
+    """Compare the source against the stored fingerprint.
+
+    A size mismatch is always a miss. When size and mtime both match the
+    source is trusted without hashing unless verify_hash is set; when only
+    the mtime moved (a touch or a re-copy), the content hash decides.
+    """
+    if not os.path.exists(manifest_path):
+        return False, None
+    with open(manifest_path) as fh:
+        stored = json.load(fh)
+
+    stat = os.stat(path)
+    if stat.st_size != stored['size']:
+        return False, None
+    if stat.st_mtime_ns == stored['mtime_ns'] and not verify_hash:
+        return True, stored
+
+    current = file_fingerprint(path)
+    return current['sha256'] == stored['sha256'], current
+
+
+def _write_atomic(df, parquet_path, manifest_path, fingerprint, date_col):
+    tmp_parquet = parquet_path + '.tmp'
+    tmp_manifest = manifest_path + '.tmp'
+    # the date index duplicates a column, so store the columns only
+    df.to_parquet(tmp_parquet, index=False)
+    with open(tmp_manifest, 'w') as fh:
+        json.dump(dict(fingerprint, date_col=date_col), fh)
+    os.replace(tmp_parquet, parquet_path)
+    os.replace(tmp_manifest, manifest_path)
+
+
+def _load_cached(path, loader, cleaner, date_col, cache_dir, refresh, verify_hash):
+    cache_dir, parquet_path, manifest_path = _cache_paths(path, cache_dir)
+
+    if not refresh and os.path.exists(parquet_path):
+        fresh, fingerprint = _cache_is_fresh(path, manifest_path, verify_hash)
+        if fresh:
+            try:
+                df = pd.read_parquet(parquet_path)
+            except ImportError:
+                return cleaner(loader(path))
+            df.index = df[date_col]
+            if fingerprint.get('date_col') is None:
+                # verified by hash after the mtime moved: record the new
+                # mtime so the next run takes the fast path again
+                with open(manifest_path, 'w') as fh:
+                    json.dump(dict(fingerprint, date_col=date_col), fh)
+            return df
+
+    df = cleaner(loader(path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_atomic(df, parquet_path, manifest_path, file_fingerprint(path), date_col)
+    except ImportError:
+        # no Parquet engine installed: run uncached
+        pass
+    return df
+
+
+def load_inventory_cached(path='/content/Inventory_Turnover.csv', cache_dir=None,
+                          refresh=False, verify_hash=False):
+    """Cleaned df_inventory, served from the Parquet cache when the CSV is unchanged."""
+    return _load_cached(path, load_inventory, clean_inventory, 'dispense_date',
+                        cache_dir, refresh, verify_hash)
+
+
+def load_restock_cached(path='/content/Restock_data.csv', cache_dir=None,
+                        refresh=False, verify_hash=False):
+    """Cleaned df_restock, served from the Parquet cache when the CSV is unchanged."""
+    return _load_cached(path, load_restock, clean_restock, 'restock_date',
+                        cache_dir, refresh, verify_hash)
+
+
+# ---------------------------------------------------------------------------
+# Incremental append ingestion
+# ---------------------------------------------------------------------------
+
+# per-feed column names, matching the Step 4 daily / monthly tables
+FEEDS = {
+    'inventory': {
+        'loader':      load_inventory,
+        'cleaner':     clean_inventory,
+        'dtypes':      INVENTORY_DTYPES,
+        'date_format': DISPENSE_DATE_FORMAT,
+        'date_col':    'dispense_date',
+        'value_col':   'qty_dispensed',
+        'daily_col':   'qty_dispensed',
+        'monthly_col': 'dispensed_qty',
+    },
+    'restock': {
+        'loader':      load_restock,
+        'cleaner':     clean_restock,
+        'dtypes':      RESTOCK_DTYPES,
+        'date_format': RESTOCK_DATE_FORMAT,
+        'date_col':    'restock_date',
+        'value_col':   'total',
+        'daily_col':   'total_restocked',
+        'monthly_col': 'monthly_restocked_qty',
+    },
+}
+
+STORE_DIRNAME = '.vending_store'
+
+
+def daily_table(df, kind):
+    """One row per (device_id, date) with the feed's value summed (daily_inventory / daily_restock)."""
+    feed = FEEDS[kind]
+    return (
+        df
+          .assign(date=df[feed['date_col']].dt.normalize())
+          .groupby(['device_id', 'date'], as_index=False, observed=True)
+          .agg(**{feed['daily_col']: (feed['value_col'], 'sum')})
+    )
+
+
+def monthly_table(daily, kind):
+    """Fleet-wide month-end totals from a daily table (inv_monthly / rest_monthly)."""
+    feed = FEEDS[kind]
+    return (
+        daily
+          .set_index('date')
+          .resample('ME')[[feed['daily_col']]]
+          .sum()
+          .rename(columns={feed['daily_col']: feed['monthly_col']})
+          .sort_index()
+    )
+
+
+def _store_paths(kind, store_dir):
+    kind_dir = os.path.join(store_dir, kind)
+    return (kind_dir,
+            os.path.join(kind_dir, 'state.json'),
+            os.path.join(kind_dir, 'daily.parquet'),
+            os.path.join(kind_dir, 'monthly.parquet'))
+
+
+def _as_category(df, columns):
+    for col in columns:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def _category_columns(kind):
+    dtypes = INVENTORY_DTYPES if kind == 'inventory' else RESTOCK_DTYPES
+    return [col for col, dtype in dtypes.items() if dtype == 'category']
+
+
+def _row_hashes(df):
+    # compare on plain values: the stored and new categoricals have different categories
+    plain = df.reset_index(drop=True)
+    plain = plain.astype({col: object for col in plain.columns
+                          if isinstance(plain[col].dtype, pd.CategoricalDtype)})
+    return pd.util.hash_pandas_object(plain, index=False)
+
+
+def _save_state(state_path, state):
+    tmp = state_path + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh, indent=1)
+    os.replace(tmp, state_path)
+
+
+def init_incremental_store(kind, path, store_dir=None):
+    """Seed the store for one feed from a full CSV; returns (df, daily, monthly).
+
+    The cleaned rows become the first history part, the daily and monthly
+    tables are built once, and the high-water mark is the latest date seen.
+    """
+    feed = FEEDS[kind]
+    if store_dir is None:
+        store_dir = os.path.join(os.path.dirname(os.path.abspath(path)), STORE_DIRNAME)
+    kind_dir, state_path, daily_path, monthly_path = _store_paths(kind, store_dir)
+    os.makedirs(kind_dir, exist_ok=True)
+
+    df = feed['cleaner'](feed['loader'](path))
+    daily = daily_table(df, kind)
+    monthly = monthly_table(daily, kind)
+
+    part = 'part-00000.parquet'
+    df.to_parquet(os.path.join(kind_dir, part), index=False)
+    daily.to_parquet(daily_path, index=False)
+    monthly.to_parquet(monthly_path)
+    _save_state(state_path, {
+        'high_water_mark': df[feed['date_col']].max().isoformat(),
+        'parts': [{
+            'file': part,
+            'rows': len(df),
+            'min':  df[feed['date_col']].min().isoformat(),
+            'max':  df[feed['date_col']].max().isoformat(),
+        }],
+    })
+    return df, daily, monthly
+
+
+def load_incremental_store(kind, store_dir):
+    """Full cleaned history plus the stored daily and monthly tables."""
+    feed = FEEDS[kind]
+    kind_dir, state_path, daily_path, monthly_path = _store_paths(kind, store_dir)
+    with open(state_path) as fh:
+        state = json.load(fh)
+
+    parts = [pd.read_parquet(os.path.join(kind_dir, p['file'])) for p in state['parts']]
+    df = _as_category(pd.concat(parts, ignore_index=True), _category_columns(kind))
+    df.index = df[feed['date_col']]
+    daily = _as_category(pd.read_parquet(daily_path), ['device_id'])
+    monthly = pd.read_parquet(monthly_path)
+    return df, daily, monthly
+
+
+def append_incremental(kind, path, store_dir):
+    """Append one new log file to the store; returns (new_rows, daily, monthly).
+
+    Only rows on or after the stored high-water mark are taken. Rows on the
+    boundary are deduplicated against the history parts that reach the mark
+    (a small slice, found from the per-part date ranges), so a re-delivered
+    file is a no-op. The daily and monthly tables are updated only from the
+    boundary date/month onward; earlier rows are left untouched.
+    """
+    feed = FEEDS[kind]
+    date_col = feed['date_col']
+    kind_dir, state_path, daily_path, monthly_path = _store_paths(kind, store_dir)
+    with open(state_path) as fh:
+        state = json.load(fh)
+    hwm = pd.Timestamp(state['high_water_mark'])
+
+    daily = _as_category(pd.read_parquet(daily_path), ['device_id'])
+    monthly = pd.read_parquet(monthly_path)
+
+    new = feed['cleaner'](feed['loader'](path))
+    new = new[new[date_col] >= hwm]
+
+    # dedup the boundary rows against the stored history
+    on_boundary = new[date_col] == hwm
+    if on_boundary.any():
+        seen = [
+            pd.read_parquet(os.path.join(kind_dir, p['file']), filters=[(date_col, '>=', hwm)])
+            for p in state['parts'] if pd.Timestamp(p['max']) >= hwm
+        ]
+        if seen:
+            seen_hashes = set(_row_hashes(pd.concat(seen, ignore_index=True)))
+            new = new[~(on_boundary & _row_hashes(new).isin(seen_hashes).to_numpy())]
+
+    if new.empty:
+        return new, daily, monthly
+
+    # history: one more part file, nothing rewritten
+    part = 'part-%05d.parquet' % len(state['parts'])
+    new.to_parquet(os.path.join(kind_dir, part), index=False)
+
+    # daily: re-sum only the (device_id, date) keys from the boundary day on
+    new_daily = daily_table(new, kind)
+    cut = new_daily['date'].min()
+    head = daily[daily['date'] < cut]
+    tail = pd.concat([daily[daily['date'] >= cut], new_daily], ignore_index=True)
+    tail = _as_category(tail, ['device_id'])
+    tail = tail.groupby(['device_id', 'date'], as_index=False, observed=True)[feed['daily_col']].sum()
+    daily = _as_category(pd.concat([head, tail], ignore_index=True), ['device_id'])
+
+    # monthly: add the new month-end sums, zero-filling any skipped months
+    new_monthly = monthly_table(new_daily, kind)
+    index = pd.date_range(min(monthly.index.min(), new_monthly.index.min()),
+                          max(monthly.index.max(), new_monthly.index.max()), freq='ME')
+    monthly = (
+        monthly.reindex(index, fill_value=0)
+          .add(new_monthly.reindex(index, fill_value=0), fill_value=0)
+          .astype(monthly.dtypes.to_dict())
+    )
+    monthly.index.name = 'date'
+
+    daily.to_parquet(daily_path, index=False)
+    monthly.to_parquet(monthly_path)
+    state['parts'].append({
+        'file': part,
+        'rows': len(new),
+        'min':  new[date_col].min().isoformat(),
+        'max':  new[date_col].max().isoformat(),
+    })
+    state['high_water_mark'] = max(hwm, new[date_col].max()).isoformat()
+    _save_state(state_path, state)
+    return new, daily, monthly
+
+
+# ---------------------------------------------------------------------------
+# Chunked streaming aggregation
+# ---------------------------------------------------------------------------
+
+def iter_csv_chunks(path, kind, chunksize=500_000, usecols=None):
+    """Yield typed, date-parsed chunks of one feed's CSV without reading it whole."""
+    feed = FEEDS[kind]
+    dtypes = feed['dtypes']
+    if usecols is not None:
+        usecols = list(usecols)
+        if feed['date_col'] not in usecols:
+            usecols.append(feed['date_col'])
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in usecols}
+
+    reader = pd.read_csv(path, usecols=usecols, dtype=dtypes,
+                         encoding='utf-8-sig', chunksize=chunksize)
+    for chunk in reader:
+        chunk[feed['date_col']] = pd.to_datetime(chunk[feed['date_col']],
+                                                 format=feed['date_format'])
+        yield chunk
+
+
+def _combine_partials(partials, keys, value_col):
+    combined = pd.concat(partials, ignore_index=True)
+    # per-chunk categoricals have different categories; re-intern after concat
+    combined = _as_category(combined, [k for k in keys if k != 'date'])
+    return combined.groupby(keys, as_index=False, observed=True)[value_col].sum()
+
+
+def stream_aggregates(chunks, kind='inventory', combine_every=8):
+    """Roll an iterable of record batches up to the Step 4 daily and monthly tables.
+
+    Each batch is reduced to (device_id[, sku], date) partial sums straight
+    away, and the partials are merged every combine_every batches, so memory
+    is bounded by the number of distinct keys rather than the number of rows.
+    When the batches carry every column of the feed, exact duplicate rows
+    are dropped across the whole stream by keeping a running set of row
+    hashes (one per distinct row, the only state that grows with the rows),
+    so the totals match clean_inventory / clean_restock on the full load.
+    Rows of a projected batch that look alike may differ in a column that
+    was left out (package_qty, global_order_id), so those are summed as they
+    are and the totals can exceed the full load's by its duplicate rows.
+
+    Returns a dict with:
+      daily_by_key   -- one row per (device_id[, sku], date)
+      daily          -- one row per (device_id, date), as daily_inventory / daily_restock
+      monthly_by_key -- month-end sums per (device_id[, sku])
+      monthly        -- fleet month-end totals, as inv_monthly / rest_monthly
+    """
+    feed = FEEDS[kind]
+    value_col = feed['daily_col']
+    # fixed column order, so batches with reordered columns hash alike
+    full_row = sorted(set(feed['dtypes']) | {feed['date_col']})
+    seen = set()
+    keys = None
+    partials = []
+    total = None
+
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        if keys is None:
+            keys = ['device_id'] + (['sku'] if 'sku' in chunk.columns else []) + ['date']
+        if set(full_row) <= set(chunk.columns):
+            hashes = _row_hashes(chunk[full_row])
+            keep = ~(hashes.duplicated() | hashes.isin(seen)).to_numpy()
+            seen.update(hashes[keep].tolist())
+            chunk = chunk[keep]
+        partial = (
+            chunk
+              .assign(date=chunk[feed['date_col']].dt.normalize())
+              .groupby(keys, as_index=False, observed=True)
+              .agg(**{value_col: (feed['value_col'], 'sum')})
+        )
+        partials.append(partial)
+        if len(partials) >= combine_every:
+            if total is not None:
+                partials.insert(0, total)
+            total = _combine_partials(partials, keys, value_col)
+            partials = []
+
+    if keys is None:
+        raise ValueError('no rows to aggregate')
+    if partials:
+        if total is not None:
+            partials.insert(0, total)
+        total = _combine_partials(partials, keys, value_col)
+
+    daily_by_key = total.sort_values(keys, ignore_index=True)
+    daily = (
+        daily_by_key
+          .groupby(['device_id', 'date'], as_index=False, observed=True)[value_col]
+          .sum()
+    )
+    monthly_by_key = (
+        daily_by_key
+          .assign(date=daily_by_key['date'].dt.to_period('M').dt.to_timestamp('M'))
+          .groupby(keys, as_index=False, observed=True)[value_col]
+          .sum()
+          .rename(columns={'date': 'month_end'})
+    )
+    return {
+        'daily_by_key':   daily_by_key,
+        'daily':          daily,
+        'monthly_by_key': monthly_by_key,
+        'monthly':        monthly_table(daily, kind),
+    }
+
+
+def stream_csv_aggregates(path, kind='inventory', chunksize=500_000, combine_every=8):
+    """stream_aggregates() over a CSV read in chunks.
+
+    Every column is read so that duplicates are judged on the full row, as
+    clean_inventory() / clean_restock() do; each chunk is reduced to partial
+    sums straight away, so memory stays bounded by chunksize.
+    """
+    chunks = iter_csv_chunks(path, kind, chunksize=chunksize)
+    return stream_aggregates(chunks, kind=kind, combine_every=combine_every)
+
+
+# ---------------------------------------------------------------------------
+# Integer-coded id dictionaries
+# ---------------------------------------------------------------------------
+
+ID_COLUMNS = ('sku', 'device_id', 'global_order_id')
+
+
+class IdDictionary:
+    """Dense int32 codes for one id column, with reverse lookup for display.
+
+    Codes are positions in ``labels``. New labels are only ever appended, so
+    a saved dictionary keeps every existing code stable across runs.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = pd.Index([] if labels is None else list(labels), dtype=object)
+        if not self.labels.is_unique:
+            raise ValueError('id labels must be unique')
+
+    @classmethod
+    def from_values(cls, *columns):
+        """Build from one or more columns; labels are sorted for reproducible codes."""
+        uniques = set()
+        for col in columns:
+            uniques.update(_unique_labels(col))
+        return cls(sorted(uniques))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def extend(self, values):
+        """Append labels not seen before; existing codes are unchanged."""
+        new = [v for v in _unique_labels(values) if v not in self.labels]
+        if new:
+            self.labels = self.labels.append(pd.Index(sorted(new), dtype=object))
+        return self
+
+    def encode(self, values):
+        """int32 codes for values; labels not in the dictionary map to -1.
+
+        Categorical input is encoded through its categories, so each distinct
+        string is hashed once rather than once per row.
+        """
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            cat = values.array if isinstance(values, pd.Series) else values
+            lookup = self.labels.get_indexer(cat.categories).astype(np.int32)
+            codes = np.asarray(cat.codes)
+            return np.where(codes < 0, -1, lookup[codes]).astype(np.int32)
+        return self.labels.get_indexer(pd.Index(values, dtype=object)).astype(np.int32)
+
+    def decode(self, codes):
+        """Labels for an array of codes."""
+        return self.labels.take(np.asarray(codes)).to_numpy()
+
+    def categorical(self, values):
+        """values as a Categorical over this dictionary, so pandas groups on the codes."""
+        return pd.Categorical.from_codes(self.encode(values), categories=self.labels)
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.labels.tolist(), fh)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            return cls(json.load(fh))
+
+
+def _unique_labels(values):
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        return [v for v in pd.unique(values.dropna()) if v is not None]
+    return pd.unique(pd.Series(values).dropna()).tolist()
+
+
+def intern_ids(*frames, dictionaries=None):
+    """Recode the id columns of every frame onto shared dictionaries, in place.
+
+    device_id gets one dictionary across the dispense and restock frames, so
+    its codes line up between the two. Passing previously saved dictionaries
+    extends them with unseen labels instead of renumbering. Returns the
+    {column: IdDictionary} mapping.
+    """
+    dictionaries = dict(dictionaries or {})
+    for col in ID_COLUMNS:
+        columns = [df[col] for df in frames if col in df.columns]
+        if not columns:
+            continue
+        if col in dictionaries:
+            for values in columns:
+                dictionaries[col].extend(values)
+        else:
+            dictionaries[col] = IdDictionary.from_values(*columns)
+        for df in frames:
+            if col in df.columns:
+                df[col] = dictionaries[col].categorical(df[col])
+    return dictionaries